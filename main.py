@@ -2,22 +2,35 @@ import logging
 from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
 import sqlite3
 import os
+import queue
 import sys
 import asyncio
 import aiohttp
 import base64
+import bisect
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import random
 import urllib.parse
-from datetime import datetime, timedelta, time as dtime
+from collections import OrderedDict, deque
+from datetime import date, datetime, time as dtime
 import re
 import traceback
-from functools import wraps
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import wraps, partial, lru_cache
 import edge_tts
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    PreCheckoutQueryHandler, ContextTypes, filters
+    PreCheckoutQueryHandler, ChatMemberHandler, ContextTypes, BaseRateLimiter, BaseUpdateProcessor, filters
 )
-from telegram.error import TelegramError, NetworkError, TimedOut
+from telegram.error import TelegramError, NetworkError, TimedOut, RetryAfter, BadRequest, Forbidden
 
 # ============================================================
 # === НАСТРОЙКИ ===
@@ -45,10 +58,10 @@ else:
 # Пути к файлам
 DB_NAME = os.path.join(DATA_DIR, "sport.db")
 LOG_DIR = os.path.join(DATA_DIR, "logs")
-VOICE_DIR = os.path.join(DATA_DIR, "voice_temp")
+VOICE_CACHE_DIR = os.path.join(DATA_DIR, "voice_cache")
 
 # Создаём папки
-for directory in [LOG_DIR, VOICE_DIR]:
+for directory in [LOG_DIR, VOICE_CACHE_DIR]:
     if not os.path.exists(directory):
         os.makedirs(directory)
         print(f"📁 Created: {directory}")
@@ -60,10 +73,95 @@ ADMIN_IDS = [7585768704]
 REQUIRED_CHANNEL = "@Murasaki_lab"
 CHECK_SUBSCRIPTION = True  # Включить проверку подписки
 
+# Кэш подписки (секунды): участники, не участники, обновление в фоне до истечения
+SUBSCRIPTION_TTL = int(os.environ.get("SUBSCRIPTION_TTL", "3600"))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.environ.get("SUBSCRIPTION_NEGATIVE_TTL", "60"))
+SUBSCRIPTION_REFRESH_AHEAD = int(os.environ.get("SUBSCRIPTION_REFRESH_AHEAD", "600"))
+
+# Бесплатные вопросы в день
+FREE_QUESTIONS_PER_DAY = 5
+
+# Бюджет памяти LRU-кэша строк users (байты)
+USER_CACHE_MAX_BYTES = int(os.environ.get("USER_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# HTTP-клиент: пулы keep-alive соединений к Groq, Giphy и ImgBB
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = int(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "75"))
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", "600"))
+HTTP_WARMUP_CONNECTIONS = int(os.environ.get("HTTP_WARMUP_CONNECTIONS", "2"))
+
+# Стриминг ответов LLM: не чаще одного edit_text в интервал и не меньше N новых символов
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_MIN_DELTA_CHARS = int(os.environ.get("STREAM_MIN_DELTA_CHARS", "40"))
+
+# Кэш ответов LLM для промптов без контекста (тренировки, рецепты, техника)
+LLM_CACHE_VARIANTS = int(os.environ.get("LLM_CACHE_VARIANTS", "3"))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ROWS = int(os.environ.get("LLM_CACHE_MAX_ROWS", "5000"))
+
+# Найденные медиа для упражнений вне каталога: свежесть находок и промахов (секунды)
+EXERCISE_MEDIA_TTL = int(os.environ.get("EXERCISE_MEDIA_TTL", str(30 * 24 * 3600)))
+EXERCISE_MEDIA_NEGATIVE_TTL = int(os.environ.get("EXERCISE_MEDIA_NEGATIVE_TTL", str(24 * 3600)))
+# Рассылка напоминаний: сообщений в секунду (лимит Telegram ~30/с на бота)
+REMINDER_SEND_RATE = int(os.environ.get("REMINDER_SEND_RATE", "25"))
+
+# Рассылки: стартовая и максимальная скорость (сообщений в секунду), размер пачки из БД
+BROADCAST_RATE = int(os.environ.get("BROADCAST_RATE", "20"))
+BROADCAST_MAX_RATE = int(os.environ.get("BROADCAST_MAX_RATE", "28"))
+
+# История диалога: сообщений на пользователя и сколько пользователей держать в памяти
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", "10"))
+HISTORY_CACHE_USERS = int(os.environ.get("HISTORY_CACHE_USERS", "2000"))
+
+# Счётчики stats копятся в памяти и пишутся пачкой раз в STATS_FLUSH_INTERVAL секунд
+STATS_FLUSH_INTERVAL = int(os.environ.get("STATS_FLUSH_INTERVAL", "5"))
+
+# Служебный чат, куда при старте отправляются гифки каталога ради file_id (по умолчанию — первый админ)
+MEDIA_CACHE_CHAT_ID = int(os.environ.get("MEDIA_CACHE_CHAT_ID", "0")) or None
+
+# Лимиты Groq: запросы и токены в минуту, одновременные запросы
+GROQ_RPM = int(os.environ.get("GROQ_RPM", "30"))
+GROQ_TPM = int(os.environ.get("GROQ_TPM", "12000"))
+GROQ_MAX_CONCURRENCY = int(os.environ.get("GROQ_MAX_CONCURRENCY", "8"))
+
+# Приоритеты очередей к LLM и исходящих сообщений (меньше — раньше)
+PRIORITY_PREMIUM = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_BULK = 3
+
+# Исходящие сообщения: общий лимит бота в секунду, лимиты на чат, запас для интерактива
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", "28"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_BULK_RESERVE = int(os.environ.get("OUTBOUND_BULK_RESERVE", "5"))
+
 # Retry настройки
 MAX_RETRIES = 3
 RETRY_DELAY = 1
 
+# SQLite: размер кэша подготовленных выражений на соединение и PRAGMA,
+# которые выставляются один раз при открытии соединения
+DB_CACHED_STATEMENTS = int(os.environ.get("DB_CACHED_STATEMENTS", "256"))
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 30000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+# Потоки для работы с SQLite (event loop не ждёт диск)
+DB_WORKERS = int(os.environ.get("DB_WORKERS", "4"))
+# Сколько записей писатель объединяет в одну транзакцию (group commit)
+DB_WRITE_BATCH_MAX = int(os.environ.get("DB_WRITE_BATCH_MAX", "256"))
+
+# Сколько апдейтов обрабатывается одновременно (апдейты одного пользователя — по очереди)
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "64"))
+
 # Голоса edge-tts
 VOICE_MAP = {
     'ru': 'ru-RU-DmitryNeural',
@@ -77,6 +175,16 @@ VOICE_MAP_FEMALE = {
     'ko': 'ko-KR-SunHiNeural'
 }
 
+# Кэш озвучки: лимит места на диске под аудиофайлы (байты)
+VOICE_CACHE_MAX_BYTES = int(os.environ.get("VOICE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+# Записи кэша озвучки (и file_id), которые не использовались дольше, удаляются (секунды)
+VOICE_CACHE_TTL = int(os.environ.get("VOICE_CACHE_TTL", str(90 * 24 * 3600)))
+
+# Озвучка длинных ответов: разбиение по предложениям и параллельный синтез
+VOICE_FIRST_CHUNK_CHARS = int(os.environ.get("VOICE_FIRST_CHUNK_CHARS", "200"))
+VOICE_CHUNK_CHARS = int(os.environ.get("VOICE_CHUNK_CHARS", "600"))
+VOICE_TTS_WORKERS = int(os.environ.get("VOICE_TTS_WORKERS", "3"))
+
 # Системный промпт
 SYSTEM_PROMPT = """Ты персональный AI-тренер и нутрициолог Murasaki Sport. 
 
@@ -203,34 +311,323 @@ async def safe_reply(update: Update, text: str):
 async def notify_admins(context: ContextTypes.DEFAULT_TYPE, message: str):
     for admin_id in ADMIN_IDS:
         try:
-            await context.bot.send_message(admin_id, message[:4000], parse_mode="Markdown")
+            await context.bot.send_message(
+                admin_id, message[:4000], parse_mode="Markdown", rate_limit_args=PRIORITY_BACKGROUND
+            )
         except Exception as e:
             logger.error(f"Failed to notify admin {admin_id}: {e}")
 
 
+class ConnectionPool:
+    """Долгоживущие соединения SQLite: одно на поток, PRAGMA выставляются один раз"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            cached_statements=DB_CACHED_STATEMENTS,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        
+        with self._lock:
+            self._connections.append(conn)
+        logger.info(f"SQLite connection opened ({threading.current_thread().name})")
+        return conn
+    
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+    
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        
+        for conn in connections:
+            try:
+                conn.execute("PRAGMA optimize")
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to close SQLite connection: {e}")
+        
+        # Соединения других потоков закрыты — сбрасываем и их ссылки
+        self._local = threading.local()
+
+
+DB_POOL = ConnectionPool(DB_NAME)
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
 def db_connection():
     class DBConnection:
         def __init__(self):
             self.conn = None
+            self.savepoint = None
             
         def __enter__(self):
-            self.conn = sqlite3.connect(DB_NAME, timeout=30)
-            self.conn.row_factory = sqlite3.Row
+            batch = DB_WRITER.batch_connection()
+            if batch is not None:
+                # Внутри пачки писателя: своя точка сохранения вместо отдельной транзакции
+                self.conn, self.savepoint = batch
+                self.conn.execute(f"SAVEPOINT {self.savepoint}")
+                return self.conn
+            self.conn = DB_POOL.get()
             return self.conn
             
         def __exit__(self, exc_type, exc_val, exc_tb):
-            if self.conn:
+            if self.savepoint:
+                if exc_type is not None:
+                    self.conn.execute(f"ROLLBACK TO {self.savepoint}")
+                    logger.error(f"DB savepoint rolled back: {exc_val}")
+                self.conn.execute(f"RELEASE {self.savepoint}")
+            elif self.conn:
                 if exc_type is None:
                     self.conn.commit()
                 else:
                     self.conn.rollback()
                     logger.error(f"DB transaction rolled back: {exc_val}")
-                self.conn.close()
             return False
     
     return DBConnection()
 
 
+async def db_call(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД в пуле потоков DB_EXECUTOR"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, partial(func, *args, **kwargs))
+
+
+class DBWriter:
+    """Единственный писатель SQLite: отдельный поток с очередью записей.
+    
+    Всё, что накопилось в очереди, выполняется одной транзакцией BEGIN IMMEDIATE
+    и одним COMMIT; каждая функция работает внутри своего SAVEPOINT, так что
+    исключение откатывает всю запись целиком, но не соседние.
+    Результат каждой записи возвращается через свой Future после COMMIT.
+    Изменения памяти (кэши, PREMIUM, REMINDERS) записи регистрируют через
+    after_commit: они выполняются только после успешного COMMIT пачки.
+    """
+    
+    def __init__(self, max_batch: int):
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+    
+    def submit(self, func, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+    
+    def batch_connection(self) -> tuple | None:
+        """(соединение, имя savepoint), если текущий поток — писатель внутри пачки"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return None
+        self._local.depth += 1
+        return conn, f"w{self._local.depth}"
+    
+    def after_commit(self, callback, user_id: int | None = None, on_rollback=None):
+        """Откладывает callback до COMMIT пачки; вне пачки транзакция уже закоммичена — вызывает сразу.
+        
+        user_id — чья запись в USER_CACHE станет недостоверной, если пачка откатится.
+        on_rollback — вызывается вместо callback, если запись или пачка откатилась.
+        """
+        pending = getattr(self._local, "callbacks", None)
+        if pending is None:
+            callback()
+        else:
+            pending.append((callback, user_id, on_rollback))
+    
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread:
+            self._queue.put(None)
+            thread.join()
+    
+    def stats(self) -> dict:
+        return {'batches': self.batches, 'writes': self.writes, 'queue': self._queue.qsize()}
+    
+    def _run(self):
+        conn = DB_POOL.get()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            self._execute(conn, batch)
+            if stop:
+                return
+    
+    def _execute(self, conn: sqlite3.Connection, batch: list):
+        results = []
+        callbacks = []
+        self._local.conn = conn
+        self._local.depth = 0
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, func, args, kwargs in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._local.callbacks = []
+                # Вся запись — в своём SAVEPOINT: исключение откатывает и уже отпущенные вложенные
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, func(*args, **kwargs), None))
+                    conn.execute("RELEASE write")
+                    callbacks.extend(self._local.callbacks)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((future, None, e))
+                    self._rollback_callbacks(self._local.callbacks)
+                finally:
+                    self._local.callbacks = None
+            conn.commit()
+        except Exception as e:
+            logger.error(f"DB write batch of {len(batch)} failed: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            results = [
+                (future, None, e) for future, *_ in batch
+                if not future.done() and (future.running() or future.set_running_or_notify_cancel())
+            ]
+            # Память не трогали, но строки этих пользователей в кэше могли устареть — перечитаем из БД
+            for user_id in {user_id for _, user_id, _ in callbacks if user_id is not None}:
+                USER_CACHE.invalidate(user_id)
+            self._rollback_callbacks(callbacks)
+            callbacks = []
+        finally:
+            self._local.conn = None
+        
+        for callback, _, _ in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"DB after-commit callback failed: {e}")
+        
+        self.batches += 1
+        self.writes += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    @staticmethod
+    def _rollback_callbacks(callbacks: list):
+        for _, _, on_rollback in callbacks:
+            if on_rollback is None:
+                continue
+            try:
+                on_rollback()
+            except Exception as e:
+                logger.error(f"DB rollback callback failed: {e}")
+
+
+DB_WRITER = DBWriter(DB_WRITE_BATCH_MAX)
+
+
+def after_commit(callback, user_id: int | None = None, on_rollback=None):
+    """Обновление памяти, которое должно случиться только после COMMIT записи (см. DBWriter.after_commit)"""
+    DB_WRITER.after_commit(callback, user_id, on_rollback)
+
+
+async def db_write(func, *args, **kwargs):
+    """Выполняет запись через DB_WRITER: одна транзакция на всю накопившуюся очередь"""
+    return await asyncio.wrap_future(DB_WRITER.submit(func, *args, **kwargs))
+
+
+class HttpClient:
+    """Общая aiohttp-сессия на всё время работы бота"""
+    
+    def __init__(self):
+        self._session = None
+    
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+    
+    async def warm_up(self):
+        """Заранее открывает TCP+TLS соединения, чтобы первый запрос не платил за рукопожатие"""
+        targets = [("https://api.groq.com/openai/v1/models", {"Authorization": f"Bearer {GROQ_API_KEY}"})]
+        if GIPHY_API_KEY:
+            targets.append(("https://api.giphy.com/", {}))
+        if IMGBB_API_KEY:
+            targets.append(("https://api.imgbb.com/", {}))
+        
+        async def _touch(url: str, headers: dict):
+            try:
+                async with self.session.head(url, headers=headers, timeout=10) as resp:
+                    await resp.release()
+            except Exception as e:
+                logger.warning(f"HTTP warm-up failed for {url}: {e}")
+        
+        await asyncio.gather(*(
+            _touch(url, headers)
+            for url, headers in targets
+            for _ in range(HTTP_WARMUP_CONNECTIONS)
+        ))
+        logger.info(f"HTTP pool warmed up: {len(targets)} hosts")
+    
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+            # Даём SSL-транспортам закрыться корректно
+            await asyncio.sleep(0.25)
+        self._session = None
+
+
+HTTP = HttpClient()
+
+
+class RateLimited(aiohttp.ClientError):
+    """Upstream ответил 429; retry_after — сколько секунд ждать"""
+    
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
 async def retry_async(func, *args, max_retries=MAX_RETRIES, delay=RETRY_DELAY, **kwargs):
     last_exception = None
     
@@ -240,41 +637,295 @@ async def retry_async(func, *args, max_retries=MAX_RETRIES, delay=RETRY_DELAY, *
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             last_exception = e
             logger.warning(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
-            if attempt < max_retries - 1:
+            # На 429 паузу по Retry-After выдерживает LLMGovernor, свой backoff не нужен
+            if attempt < max_retries - 1 and not isinstance(e, RateLimited):
                 await asyncio.sleep(delay * (attempt + 1))
     
     raise last_exception
 
 
+# ============================================================
+# === ИСХОДЯЩИЕ СООБЩЕНИЯ ===
+# ============================================================
+
+class OutboundLimiter(BaseRateLimiter):
+    """Общая очередь всех отправок бота: приоритеты, общий token bucket и пейсинг по чатам.
+    
+    Приоритет передаётся через rate_limit_args (по умолчанию — интерактивный).
+    Массовые отправки (PRIORITY_BULK) не берут последние OUTBOUND_BULK_RESERVE
+    токенов, чтобы ответы пользователям не ждали рассылку. Запросы без
+    сообщения в чат (answerCallbackQuery, getChatMember и т.п.) идут мимо очереди.
+    После RetryAfter очередь стоит до истечения паузы, запрос повторяется.
+    """
+    
+    MAX_RETRIES = 2
+    
+    def __init__(self, rate: float, chat_rate: float, group_rate: float, chat_burst: int, bulk_reserve: int):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.bulk_reserve = bulk_reserve
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._chats = {}
+        self._paused_until = 0.0
+        self._queue = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self.sent = 0
+        self.throttled = 0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+    
+    @staticmethod
+    def is_limited(endpoint: str, data: dict) -> bool:
+        return (
+            data.get("chat_id") is not None
+            and endpoint.startswith(("send", "edit", "copy", "forward"))
+            and endpoint != "sendChatAction"
+        )
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not self.is_limited(endpoint, data):
+            return await callback(*args, **kwargs)
+        
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data["chat_id"]
+        
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                self.pause(e.retry_after)
+                if attempt == self.MAX_RETRIES:
+                    raise
+    
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.throttled += 1
+        logger.warning(f"Telegram flood wait, pausing outbound queue for {seconds}s")
+        self._dispatch()
+    
+    def stats(self) -> dict:
+        return {
+            'queue': sum(1 for *_, fut in self._queue if not fut.done()),
+            'sent': self.sent,
+            'throttled': self.throttled
+        }
+    
+    async def _acquire(self, priority: int, chat_id):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), chat_id, fut))
+        self._dispatch()
+        await fut
+    
+    def _chat_rate(self, chat_id) -> float:
+        # Отрицательные id и @username — группы и каналы: у них лимит 20 сообщений в минуту
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        return self.group_rate if is_group else self.chat_rate
+    
+    def _chat_tokens(self, chat_id, now: float) -> float:
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        return min(self.chat_burst, tokens + (now - updated) * self._chat_rate(chat_id))
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        
+        if len(self._chats) > 10000:
+            # Полные бакеты неотличимы от отсутствующих — выбрасываем их
+            self._chats = {
+                chat_id: state for chat_id, state in self._chats.items()
+                if self._chat_tokens(chat_id, now) < self.chat_burst
+            }
+    
+    def _dispatch(self):
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+        
+        now = time.monotonic()
+        self._refill(now)
+        wait = None
+        skipped = []
+        
+        if now < self._paused_until:
+            wait = self._paused_until - now
+        else:
+            while self._queue:
+                entry = heapq.heappop(self._queue)
+                priority, _, chat_id, fut = entry
+                if fut.done():
+                    continue
+                
+                # Очередь упорядочена по приоритету: дальше только такие же или менее важные
+                reserve = self.bulk_reserve if priority >= PRIORITY_BULK else 0
+                if self._tokens < 1 + reserve:
+                    skipped.append(entry)
+                    token_wait = (1 + reserve - self._tokens) / self.rate
+                    wait = token_wait if wait is None else min(wait, token_wait)
+                    break
+                
+                chat_tokens = self._chat_tokens(chat_id, now)
+                if chat_tokens < 1:
+                    # Чат упёрся в свой лимит — не задерживаем остальные чаты
+                    skipped.append(entry)
+                    chat_wait = (1 - chat_tokens) / self._chat_rate(chat_id)
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                
+                self._tokens -= 1
+                self._chats[chat_id] = (chat_tokens - 1, now)
+                fut.set_result(None)
+        
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        
+        if wait is not None:
+            self._wakeup = asyncio.get_running_loop().call_later(max(wait, 0.01), self._dispatch)
+
+
+OUTBOUND = OutboundLimiter(OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_BULK_RESERVE)
+
+
 # ============================================================
 # === ПРОВЕРКА ПОДПИСКИ НА КАНАЛ ===
 # ============================================================
 
-async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Проверяет подписку пользователя на канал"""
-    if not CHECK_SUBSCRIPTION:
-        return True
+MEMBER_STATUSES = ('creator', 'administrator', 'member')
+
+
+class MembershipIndex:
+    """Кэш подписки на REQUIRED_CHANNEL с TTL и негативным кэшированием.
     
-    if user_id in ADMIN_IDS:
-        return True
+    Пополняется проверками get_chat_member и апдейтами chat_member из канала.
+    """
+    
+    def __init__(self):
+        self._entries = {}
+        self._refreshing = set()
+        self._tasks = set()
+    
+    def get(self, user_id: int) -> tuple | None:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry
+    
+    def set(self, user_id: int, is_member: bool, ttl: int = None):
+        if ttl is None:
+            ttl = SUBSCRIPTION_TTL if is_member else SUBSCRIPTION_NEGATIVE_TTL
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+    
+    def refresh_in_background(self, user_id: int, bot):
+        if user_id in self._refreshing:
+            return
+        self._refreshing.add(user_id)
+        task = asyncio.create_task(self._refresh(user_id, bot))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _refresh(self, user_id: int, bot):
+        try:
+            await fetch_subscription(user_id, bot)
+        finally:
+            self._refreshing.discard(user_id)
+    
+    def prune(self) -> int:
+        now = time.monotonic()
+        expired = [uid for uid, (_, expires_at) in self._entries.items() if expires_at <= now]
+        for uid in expired:
+            del self._entries[uid]
+        return len(expired)
     
+    def __len__(self):
+        return len(self._entries)
+
+
+SUBSCRIPTIONS = MembershipIndex()
+
+
+async def fetch_subscription(user_id: int, bot) -> bool:
+    """Запрашивает статус в канале через Bot API и кладёт результат в кэш"""
     try:
-        member = await context.bot.get_chat_member(
+        member = await bot.get_chat_member(
             chat_id=REQUIRED_CHANNEL, 
             user_id=user_id
         )
-        is_member = member.status in ['creator', 'administrator', 'member']
+        is_member = member.status in MEMBER_STATUSES
         logger.info(f"Subscription check for {user_id}: {member.status} -> {is_member}")
+        SUBSCRIPTIONS.set(user_id, is_member)
         return is_member
     except TelegramError as e:
         logger.warning(f"Subscription check failed for {user_id}: {e}")
         # Если бот не админ канала — пропускаем проверку
+        SUBSCRIPTIONS.set(user_id, True, ttl=SUBSCRIPTION_NEGATIVE_TTL)
         return True
     except Exception as e:
         logger.error(f"Unexpected error checking subscription: {e}")
         return True
 
 
+async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE, force: bool = False) -> bool:
+    """Проверяет подписку пользователя на канал"""
+    if not CHECK_SUBSCRIPTION:
+        return True
+    
+    if user_id in ADMIN_IDS:
+        return True
+    
+    if not force:
+        cached = SUBSCRIPTIONS.get(user_id)
+        if cached is not None:
+            is_member, expires_at = cached
+            if is_member and expires_at - time.monotonic() < SUBSCRIPTION_REFRESH_AHEAD:
+                SUBSCRIPTIONS.refresh_in_background(user_id, context.bot)
+            return is_member
+    
+    return await fetch_subscription(user_id, context.bot)
+
+
+async def track_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновляет кэш подписки по апдейтам chat_member из канала (бот должен быть админом)"""
+    change = update.chat_member
+    if not change or not change.chat.username:
+        return
+    if change.chat.username.lower() != REQUIRED_CHANNEL.lstrip('@').lower():
+        return
+    
+    user_id = change.new_chat_member.user.id
+    is_member = change.new_chat_member.status in MEMBER_STATUSES
+    SUBSCRIPTIONS.set(user_id, is_member)
+    logger.info(f"Channel member update for {user_id}: {change.new_chat_member.status}")
+
+
+async def track_bot_blocked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмечает пользователей, заблокировавших бота в личке: рассылки их пропускают"""
+    change = update.my_chat_member
+    if not change or change.chat.type != "private":
+        return
+    
+    blocked = change.new_chat_member.status == "kicked"
+    await db_write(set_user_blocked, change.chat.id, blocked)
+    logger.info(f"User {change.chat.id} {'blocked' if blocked else 'unblocked'} the bot")
+
+
+async def prune_subscriptions_job(context: ContextTypes.DEFAULT_TYPE):
+    pruned = SUBSCRIPTIONS.prune()
+    if pruned:
+        logger.info(f"Pruned {pruned} expired subscription entries")
+
+
 async def show_subscription_required(update: Update):
     """Показывает сообщение о необходимости подписки"""
     keyboard = [
@@ -321,12 +972,9 @@ async def backup_database(context: ContextTypes.DEFAULT_TYPE):
         
         backup_name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
         
-        with db_connection() as conn:
-            backup_conn = sqlite3.connect(backup_name)
-            conn.backup(backup_conn)
-            backup_conn.close()
+        await db_call(write_backup_file, backup_name)
         
-        stats = get_backup_stats()
+        stats = await db_call(get_backup_stats)
         
         for admin_id in ADMIN_IDS:
             try:
@@ -342,30 +990,45 @@ async def backup_database(context: ContextTypes.DEFAULT_TYPE):
                             f"💎 Premium: {stats['premium']}\n"
                             f"📊 Размер: {stats['size_kb']:.1f} KB"
                         ),
-                        parse_mode="Markdown"
+                        parse_mode="Markdown",
+                        rate_limit_args=PRIORITY_BACKGROUND
                     )
             except Exception as e:
                 logger.error(f"Failed to send backup to {admin_id}: {e}")
         
-        os.remove(backup_name)
+        await asyncio.to_thread(os.remove, backup_name)
         logger.info("Database backup completed")
         
     except Exception as e:
         logger.error(f"Backup failed: {e}")
 
 
+def write_backup_file(backup_name: str):
+    with db_connection() as conn:
+        backup_conn = sqlite3.connect(backup_name)
+        conn.backup(backup_conn)
+        backup_conn.close()
+
+
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM users"
+SQL_COUNT_PREMIUM = "SELECT COUNT(*) FROM users WHERE is_premium = 1"
+SQL_COUNT_WORKOUTS = "SELECT COUNT(*) FROM workouts"
+
+
 def get_backup_stats() -> dict:
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
+            cursor.execute(SQL_COUNT_USERS)
             users = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_premium = 1")
+            cursor.execute(SQL_COUNT_PREMIUM)
             premium = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM workouts")
+            cursor.execute(SQL_COUNT_WORKOUTS)
             workouts = cursor.fetchone()[0]
-            cursor.execute("SELECT SUM(total_questions) FROM stats")
-            questions = cursor.fetchone()[0] or 0
+            totals = STATS_BUFFER.read(
+                lambda: dict(zip(STATS_COUNTERS, conn.execute(SQL_STATS_TOTALS).fetchone()))
+            )
+            questions = totals['total_questions'] or 0
         
         size_kb = os.path.getsize(DB_NAME) / 1024
         return {'users': users, 'premium': premium, 'workouts': workouts, 'questions': questions, 'size_kb': size_kb}
@@ -373,29 +1036,38 @@ def get_backup_stats() -> dict:
         return {'users': 0, 'premium': 0, 'workouts': 0, 'questions': 0, 'size_kb': 0}
 
 
+SQL_PING = "SELECT 1"
+
+
+def ping_db():
+    with db_connection() as conn:
+        conn.execute(SQL_PING)
+
+
 async def health_check(context: ContextTypes.DEFAULT_TYPE):
     logger.info("Running health check...")
     issues = []
     
     try:
-        with db_connection() as conn:
-            conn.execute("SELECT 1")
+        await db_call(ping_db)
     except Exception as e:
         issues.append(f"❌ Database: {e}")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
-            async with session.get("https://api.groq.com/openai/v1/models", headers=headers, timeout=10) as resp:
-                if resp.status != 200:
-                    issues.append(f"⚠️ Groq API: status {resp.status}")
+        headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
+        async with HTTP.session.get("https://api.groq.com/openai/v1/models", headers=headers, timeout=10) as resp:
+            if resp.status != 200:
+                issues.append(f"⚠️ Groq API: status {resp.status}")
     except Exception as e:
         issues.append(f"❌ Groq API: {e}")
     
     if issues:
         for admin_id in ADMIN_IDS:
             try:
-                await context.bot.send_message(admin_id, f"🏥 **Health Check:**\n\n" + "\n".join(issues), parse_mode="Markdown")
+                await context.bot.send_message(
+                    admin_id, f"🏥 **Health Check:**\n\n" + "\n".join(issues),
+                    parse_mode="Markdown", rate_limit_args=PRIORITY_BACKGROUND
+                )
             except:
                 pass
 
@@ -404,108 +1076,225 @@ async def health_check(context: ContextTypes.DEFAULT_TYPE):
 # === БАЗА ДАННЫХ ===
 # ============================================================
 
+def table_columns(cursor, table: str) -> set:
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+
+
+def add_column(cursor, table: str, column: str, declaration: str) -> bool:
+    """ALTER TABLE ADD COLUMN, только если колонки ещё нет; True — колонка добавлена"""
+    if column in table_columns(cursor, table):
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    return True
+
+
+def _migration_1_base(cursor):
+    """Базовая схема (до учёта версий): таблицы, колонки прежних миграций, индексы"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            is_premium INTEGER DEFAULT 0,
+            premium_until TEXT,
+            free_questions INTEGER DEFAULT 5,
+            last_reset TEXT,
+            referral_code TEXT UNIQUE,
+            referred_by INTEGER,
+            height INTEGER,
+            weight REAL,
+            age INTEGER,
+            gender TEXT,
+            goal TEXT,
+            location TEXT,
+            equipment TEXT,
+            experience TEXT,
+            reminder_time TEXT,
+            reminder_days TEXT,
+            voice_mode INTEGER DEFAULT 0,
+            language TEXT DEFAULT 'ru',
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    for col, default in [("voice_mode", "0"), ("language", "'ru'"), ("blocked", "0")]:
+        add_column(cursor, "users", col, f"DEFAULT {default}")
+    
+    # premium_day — последний оплаченный день как date.toordinal(); переносим из premium_until
+    if add_column(cursor, "users", "premium_day", "INTEGER"):
+        cursor.execute(f"""
+            UPDATE users SET premium_day = CAST(julianday(premium_until) - {PREMIUM_DAY_OFFSET} AS INTEGER)
+            WHERE premium_until IS NOT NULL
+        """)
+        cursor.execute("UPDATE users SET is_premium = 0 WHERE is_premium = 1 AND premium_day IS NULL")
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS workouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            workout_text TEXT NOT NULL,
+            completed INTEGER DEFAULT 0,
+            date TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS progress (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            weight REAL,
+            date TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            user_id INTEGER PRIMARY KEY,
+            total_questions INTEGER DEFAULT 0,
+            workouts_completed INTEGER DEFAULT 0,
+            recipes_generated INTEGER DEFAULT 0,
+            referrals_count INTEGER DEFAULT 0
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS exercises (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            aliases TEXT,
+            description TEXT,
+            muscles TEXT,
+            gif_url TEXT,
+            video_url TEXT,
+            image_url TEXT
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cache_key TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS voice_cache (
+            hash TEXT PRIMARY KEY,
+            file_id TEXT,
+            size INTEGER DEFAULT 0,
+            last_used INTEGER NOT NULL
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS exercise_media (
+            query_norm TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            gif_url TEXT,
+            gif_file_id TEXT,
+            video_url TEXT,
+            found INTEGER DEFAULT 0,
+            fetched_at INTEGER NOT NULL
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            admin_chat_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT
+        )
+    """)
+    
+    for table in ["exercises", "exercise_media"]:
+        add_column(cursor, table, "gif_file_id", "TEXT")
+    
+    cursor.execute("SELECT COUNT(*) FROM exercises")
+    if cursor.fetchone()[0] == 0:
+        _insert_default_exercises(cursor)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referral ON users(referral_code)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_premium_day ON users(premium_day) WHERE is_premium = 1")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_workouts_user ON workouts(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_progress_user ON progress(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_key ON llm_cache(cache_key, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_voice_cache_used ON voice_cache(last_used)")
+
+
+def _migration_2_hot_indexes(cursor):
+    """Составные и частичные индексы под горячие запросы"""
+    # История веса: WHERE user_id = ? ORDER BY date DESC без сортировки во временном B-дереве
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_progress_user_date ON progress(user_id, date, weight)")
+    cursor.execute("DROP INDEX IF EXISTS idx_progress_user")
+    # Загрузка напоминаний: покрывающий частичный индекс только по активным premium с напоминанием.
+    # Ведущая колонка reminder_time даёт SEARCH по reminder_time > NULL и без статистики.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_reminders ON users(reminder_time, reminder_days)
+        WHERE reminder_time IS NOT NULL AND is_premium = 1
+    """)
+    # Получатели рассылки и их число: покрывающий поиск по blocked = 0 вместо обхода всей таблицы
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_blocked ON users(blocked)")
+    # referral_code уже покрыт UNIQUE-автоиндексом
+    cursor.execute("DROP INDEX IF EXISTS idx_users_referral")
+    # Очистка llm_cache по возрасту
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at)")
+    # Незавершённые рассылки при старте
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(id) WHERE status = 'running'")
+
+
+# Миграции применяются по возрастанию версии, каждая один раз; номера не переиспользуются.
+# Каждая миграция идемпотентна: DDL в SQLite коммитится сразу, и после сбоя она выполнится заново.
+SCHEMA_MIGRATIONS = (
+    (1, _migration_1_base),
+    (2, _migration_2_hot_indexes),
+)
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
 def init_db():
     logger.info(f"Initializing database: {DB_NAME}")
     
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    is_premium INTEGER DEFAULT 0,
-                    premium_until TEXT,
-                    free_questions INTEGER DEFAULT 5,
-                    last_reset TEXT,
-                    referral_code TEXT UNIQUE,
-                    referred_by INTEGER,
-                    height INTEGER,
-                    weight REAL,
-                    age INTEGER,
-                    gender TEXT,
-                    goal TEXT,
-                    location TEXT,
-                    equipment TEXT,
-                    experience TEXT,
-                    reminder_time TEXT,
-                    reminder_days TEXT,
-                    voice_mode INTEGER DEFAULT 0,
-                    language TEXT DEFAULT 'ru',
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Миграции
-            for col, default in [("voice_mode", "0"), ("language", "'ru'")]:
-                try:
-                    cursor.execute(f"ALTER TABLE users ADD COLUMN {col} DEFAULT {default}")
-                except sqlite3.OperationalError:
-                    pass
-            
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS workouts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    workout_text TEXT NOT NULL,
-                    completed INTEGER DEFAULT 0,
-                    date TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS progress (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    weight REAL,
-                    date TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS stats (
-                    user_id INTEGER PRIMARY KEY,
-                    total_questions INTEGER DEFAULT 0,
-                    workouts_completed INTEGER DEFAULT 0,
-                    recipes_generated INTEGER DEFAULT 0,
-                    referrals_count INTEGER DEFAULT 0
-                )
-            """)
-            
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS exercises (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    aliases TEXT,
-                    description TEXT,
-                    muscles TEXT,
-                    gif_url TEXT,
-                    video_url TEXT,
-                    image_url TEXT
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TEXT DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            current = cursor.fetchone()[0]
             
-            cursor.execute("SELECT COUNT(*) FROM exercises")
-            if cursor.fetchone()[0] == 0:
-                _insert_default_exercises(cursor)
-            
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referral ON users(referral_code)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_workouts_user ON workouts(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_progress_user ON progress(user_id)")
+            for version, migration in SCHEMA_MIGRATIONS:
+                if version <= current:
+                    continue
+                logger.info(f"Applying schema migration {version}: {migration.__name__}")
+                migration(cursor)
+                cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+                conn.commit()
         
-        logger.info("Database initialized successfully")
+        logger.info(f"Database initialized successfully (schema v{SCHEMA_VERSION})")
         
     except Exception as e:
         logger.error(f"Database initialization failed: {e}")
@@ -543,39 +1332,388 @@ def _insert_default_exercises(cursor):
     logger.info(f"Inserted {len(exercises_data)} exercises")
 
 
+# ============================================================
+# === КЭШ ПОЛЬЗОВАТЕЛЕЙ ===
+# ============================================================
+
+USER_COLUMNS = (
+    "user_id", "username", "is_premium", "premium_until", "free_questions", "last_reset",
+    "referral_code", "referred_by", "height", "weight", "age", "gender", "goal",
+    "location", "equipment", "experience", "reminder_time", "reminder_days",
+    "voice_mode", "language"
+)
+
+PROFILE_FIELDS = ("height", "weight", "age", "gender", "goal", "location", "equipment", "experience")
+
+
+class UserRecord:
+    """Компактная копия строки users для кэша"""
+    
+    __slots__ = USER_COLUMNS
+    
+    def __init__(self, row):
+        for column in USER_COLUMNS:
+            setattr(self, column, row[column])
+    
+    def as_dict(self) -> dict:
+        return {column: getattr(self, column) for column in USER_COLUMNS}
+    
+    def size(self) -> int:
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, column)) for column in USER_COLUMNS)
+
+
+class UserCache:
+    """LRU-кэш строк users, ограниченный бюджетом памяти.
+    
+    Все функции, меняющие users, обновляют кэш после коммита (write-through).
+    Каждое изменение пользователя получает номер (_clock); строка, прочитанная
+    до изменения, в кэш не попадает: put(record, since) её отбрасывает, даже
+    если пользователя в момент изменения в кэше не было.
+    """
+    
+    def __init__(self, max_bytes: int, write_marks: int = 4096):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_puts = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._written = OrderedDict()  # user_id -> номер последней записи, по возрастанию
+        self._write_marks = write_marks
+        # Номер последней забытой отметки: чтения, начатые раньше, проверить уже нельзя
+        self._forgotten = 0
+    
+    def begin_read(self) -> int:
+        """Номер, который надо передать в put() для строки, прочитанной после этого вызова"""
+        with self._lock:
+            return self._clock
+    
+    def _mark_written(self, user_id: int):
+        self._clock += 1
+        self._written[user_id] = self._clock
+        self._written.move_to_end(user_id)
+        while len(self._written) > self._write_marks:
+            _, self._forgotten = self._written.popitem(last=False)
+    
+    def get(self, user_id: int) -> UserRecord | None:
+        with self._lock:
+            entry = self._records.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._records.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, record: UserRecord, since: int = None) -> bool:
+        """Кладёт запись в кэш; since — begin_read() перед чтением строки из БД"""
+        if self.max_bytes <= 0:
+            return False
+        
+        size = record.size()
+        with self._lock:
+            if since is not None and (since < self._forgotten or self._written.get(record.user_id, 0) > since):
+                # Пока строка читалась, пользователя уже изменили
+                self.stale_puts += 1
+                return False
+            old = self._records.pop(record.user_id, None)
+            if old:
+                self.bytes -= old[1]
+            self._records[record.user_id] = (record, size)
+            self.bytes += size
+            
+            while self.bytes > self.max_bytes and self._records:
+                _, (_, evicted_size) = self._records.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+        return True
+    
+    def update(self, user_id: int, **fields):
+        """Применяет изменения к записи, если она есть в кэше"""
+        with self._lock:
+            self._mark_written(user_id)
+            entry = self._records.get(user_id)
+            if entry is None:
+                return
+            record, old_size = entry
+            for field, value in fields.items():
+                setattr(record, field, value)
+            size = record.size()
+            self._records[user_id] = (record, size)
+            self.bytes += size - old_size
+    
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._mark_written(user_id)
+            entry = self._records.pop(user_id, None)
+            if entry:
+                self.bytes -= entry[1]
+    
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'records': len(self._records),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale_puts': self.stale_puts,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+USER_CACHE = UserCache(USER_CACHE_MAX_BYTES)
+
+
+# ============================================================
+# === PREMIUM ===
+# ============================================================
+
+# julianday('0001-01-01') - 1: перевод даты SQLite в date.toordinal()
+PREMIUM_DAY_OFFSET = 1721424.5
+
+
+def today_ordinal() -> int:
+    return date.today().toordinal()
+
+
+SQL_LOAD_PREMIUM = "SELECT user_id, premium_day FROM users WHERE is_premium = 1 AND premium_day >= ?"
+SQL_EXTEND_PREMIUM = """
+    UPDATE users SET
+        is_premium = 1,
+        premium_day = MAX(IFNULL(premium_day, 0), :today) + :days,
+        premium_until = date(MAX(IFNULL(premium_day, 0), :today) + :days + :offset)
+    WHERE user_id = :user_id
+    RETURNING premium_day, premium_until, reminder_time, reminder_days
+"""
+SQL_EXPIRE_PREMIUM = "UPDATE users SET is_premium = 0 WHERE is_premium = 1 AND premium_day < ? RETURNING user_id"
+
+
+class PremiumIndex:
+    """user_id -> последний оплаченный день (date.toordinal()) для активных premium.
+    
+    Заполняется из БД при старте и дальше меняется точечно из activate_premium,
+    process_referral и expire_premium. Проверка premium — поиск в словаре.
+    """
+    
+    def __init__(self):
+        self._days = {}
+    
+    def load(self):
+        with db_connection() as conn:
+            rows = conn.execute(SQL_LOAD_PREMIUM, (today_ordinal(),)).fetchall()
+        self._days = {user_id: day for user_id, day in rows}
+        logger.info(f"Premium loaded: {len(self._days)} users")
+    
+    def set(self, user_id: int, day: int):
+        self._days[user_id] = day
+    
+    def discard(self, user_id: int):
+        self._days.pop(user_id, None)
+    
+    def day(self, user_id: int) -> int | None:
+        return self._days.get(user_id)
+    
+    def is_active(self, user_id: int) -> bool:
+        return self._days.get(user_id, 0) >= today_ordinal()
+    
+    def __len__(self):
+        return len(self._days)
+
+
+PREMIUM = PremiumIndex()
+
+
+def extend_premium(cursor, user_id: int, days: int):
+    """Продлевает premium от max(сегодня, текущий конец).
+    
+    Возвращает строку (premium_day, premium_until, reminder_time, reminder_days) или None;
+    PREMIUM, USER_CACHE и REMINDERS вызывающий обновляет через remember_premium() после коммита.
+    """
+    cursor.execute(
+        SQL_EXTEND_PREMIUM,
+        {'user_id': user_id, 'days': days, 'today': today_ordinal(), 'offset': PREMIUM_DAY_OFFSET}
+    )
+    return cursor.fetchone()
+
+
+def remember_premium(user_id: int, row):
+    premium_day, premium_until, reminder_time, reminder_days = row
+    PREMIUM.set(user_id, premium_day)
+    USER_CACHE.update(user_id, is_premium=1, premium_until=premium_until)
+    REMINDERS.update(user_id, reminder_time, reminder_days)
+
+
+def expire_premium() -> list:
+    """Снимает is_premium со всех истёкших одним UPDATE по частичному индексу"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_EXPIRE_PREMIUM, (today_ordinal(),))
+        expired = [row[0] for row in cursor.fetchall()]
+    
+    def forget():
+        for user_id in expired:
+            PREMIUM.discard(user_id)
+            USER_CACHE.update(user_id, is_premium=0)
+            REMINDERS.remove(user_id)
+    
+    after_commit(forget)
+    return expired
+
+
+async def expire_premium_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        expired = await db_write(expire_premium)
+        if expired:
+            logger.info(f"Premium expired: {len(expired)} users")
+    except Exception as e:
+        logger.error(f"Premium expiry error: {e}")
+
+
+# ============================================================
+# === СЧЁТЧИКИ СТАТИСТИКИ ===
+# ============================================================
+
+STATS_COUNTERS = ["total_questions", "workouts_completed", "recipes_generated", "referrals_count"]
+SQL_STATS_TOTALS = f"SELECT {', '.join(f'SUM({c})' for c in STATS_COUNTERS)} FROM stats"
+SQL_STATS_ADD = f"UPDATE stats SET {', '.join(f'{c} = {c} + ?' for c in STATS_COUNTERS)} WHERE user_id = ?"
+
+
+class StatsBuffer:
+    """Write-behind для таблицы stats: инкременты суммируются по пользователям в памяти
+    и уходят одним executemany в flush() через DB_WRITER (по таймеру и при остановке).
+    
+    Отправленные дельты вычитаются из памяти только после COMMIT, а _flush_lock
+    держится от снимка до COMMIT или отката. read() берёт ту же блокировку,
+    поэтому значение из БД плюс неотправленные дельты всегда точное.
+    """
+    
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flushing = False
+        self.flushed_rows = 0
+    
+    def add(self, user_id: int, counters: dict):
+        with self._lock:
+            deltas = self._pending.setdefault(user_id, dict.fromkeys(STATS_COUNTERS, 0))
+            for counter, amount in counters.items():
+                deltas[counter] += amount
+    
+    def flush(self) -> int:
+        """Выполняется в DB_WRITER: db_write(STATS_BUFFER.flush)"""
+        if self._flushing:
+            # Предыдущий flush в этой же пачке ещё не закоммичен; его снимок уже в транзакции
+            return 0
+        self._flush_lock.acquire()
+        with self._lock:
+            sent = {user_id: dict(deltas) for user_id, deltas in self._pending.items()}
+        if not sent:
+            self._flush_lock.release()
+            return 0
+        
+        rows = [(*(d[c] for c in STATS_COUNTERS), user_id) for user_id, d in sent.items()]
+        try:
+            with db_connection() as conn:
+                conn.executemany(SQL_STATS_ADD, rows)
+        except Exception as e:
+            logger.error(f"Stats flush failed, keeping {len(rows)} rows: {e}")
+            self._flush_lock.release()
+            return 0
+        
+        self._flushing = True
+        after_commit(partial(self._committed, sent), on_rollback=self._release)
+        return len(rows)
+    
+    def _committed(self, sent: dict):
+        with self._lock:
+            for user_id, deltas in sent.items():
+                left = self._pending.get(user_id)
+                if left is None:
+                    continue
+                for counter, amount in deltas.items():
+                    left[counter] -= amount
+                if not any(left.values()):
+                    del self._pending[user_id]
+            self.flushed_rows += len(sent)
+        self._release()
+    
+    def _release(self):
+        self._flushing = False
+        self._flush_lock.release()
+    
+    def read(self, query, *args):
+        """Выполняет query(*args) -> dict счётчиков (или None) и добавляет неотправленные дельты"""
+        with self._flush_lock:
+            result = query(*args)
+            with self._lock:
+                if result is not None:
+                    user_id = result.get('user_id')
+                    pending = [self._pending.get(user_id, {})] if user_id is not None else self._pending.values()
+                    for deltas in pending:
+                        for counter in STATS_COUNTERS:
+                            if counter in result:
+                                result[counter] = (result[counter] or 0) + deltas.get(counter, 0)
+            return result
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {'pending_users': len(self._pending), 'flushed_rows': self.flushed_rows}
+
+
+STATS_BUFFER = StatsBuffer()
+
+
+async def flush_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    await db_write(STATS_BUFFER.flush)
+
+
 # ============================================================
 # === ПОЛЬЗОВАТЕЛИ ===
 # ============================================================
 
 def generate_referral_code(user_id: int) -> str:
-    import hashlib
     return hashlib.md5(f"{user_id}{datetime.now()}".encode()).hexdigest()[:8]
 
 
-def get_or_create_user(user_id: int, username: str = None):
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-            
-            if not cursor.fetchone():
-                today = datetime.now().strftime("%Y-%m-%d")
-                ref_code = generate_referral_code(user_id)
-                cursor.execute("""
-                    INSERT INTO users (user_id, username, free_questions, last_reset, referral_code)
-                    VALUES (?, ?, 5, ?, ?)
-                """, (user_id, username, today, ref_code))
-                cursor.execute("INSERT INTO stats (user_id) VALUES (?)", (user_id,))
-                logger.info(f"New user: {user_id} (@{username})")
-    except Exception as e:
-        logger.error(f"Error in get_or_create_user: {e}")
+SQL_USER_BY_REFERRAL_CODE = "SELECT user_id FROM users WHERE referral_code = ?"
+SQL_USER_REFERRED_BY = "SELECT referred_by FROM users WHERE user_id = ?"
+SQL_SET_REFERRED_BY = "UPDATE users SET referred_by = ? WHERE user_id = ?"
+SQL_RESERVE_QUESTION = """
+    UPDATE users SET
+        free_questions =
+            (CASE WHEN last_reset IS date('now', 'localtime') THEN free_questions ELSE :daily END) - 1,
+        last_reset = date('now', 'localtime')
+    WHERE user_id = :user_id AND (
+        (last_reset IS NOT date('now', 'localtime') AND :daily > 0)
+        OR free_questions > 0
+    )
+    RETURNING free_questions, last_reset
+"""
+SQL_REFUND_QUESTION = """
+    UPDATE users SET free_questions = free_questions + 1
+    WHERE user_id = ? AND last_reset IS date('now', 'localtime') AND free_questions < ?
+    RETURNING free_questions
+"""
+SQL_REFERRAL_CODE = "SELECT referral_code FROM users WHERE user_id = ?"
+SQL_USER_STATS = """
+    SELECT u.user_id, u.free_questions, u.is_premium, s.total_questions, s.workouts_completed
+    FROM users u LEFT JOIN stats s ON u.user_id = s.user_id WHERE u.user_id = ?
+"""
+SQL_SET_BLOCKED = "UPDATE users SET blocked = ? WHERE user_id = ?"
 
 
 def process_referral(new_user_id: int, ref_code: str) -> bool:
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM users WHERE referral_code = ?", (ref_code,))
+            cursor.execute(SQL_USER_BY_REFERRAL_CODE, (ref_code,))
             result = cursor.fetchone()
             
             if not result or result[0] == new_user_id:
@@ -583,223 +1721,363 @@ def process_referral(new_user_id: int, ref_code: str) -> bool:
             
             referrer_id = result[0]
             
-            cursor.execute("SELECT referred_by FROM users WHERE user_id = ?", (new_user_id,))
+            cursor.execute(SQL_USER_REFERRED_BY, (new_user_id,))
             already = cursor.fetchone()
             if already and already[0]:
                 return False
             
-            cursor.execute("UPDATE users SET referred_by = ? WHERE user_id = ?", (referrer_id, new_user_id))
-            
-            cursor.execute("SELECT premium_until FROM users WHERE user_id = ?", (referrer_id,))
-            current = cursor.fetchone()[0]
-            
-            if current:
-                new_date = (datetime.strptime(current, "%Y-%m-%d") + timedelta(days=7)).strftime("%Y-%m-%d")
-            else:
-                new_date = (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d")
-            
-            cursor.execute("UPDATE users SET premium_until = ?, is_premium = 1 WHERE user_id = ?", (new_date, referrer_id))
-            cursor.execute("UPDATE stats SET referrals_count = referrals_count + 1 WHERE user_id = ?", (referrer_id,))
+            cursor.execute(SQL_SET_REFERRED_BY, (referrer_id, new_user_id))
+            premium = extend_premium(cursor, referrer_id, 7)
             
             logger.info(f"Referral: {new_user_id} -> {referrer_id}")
-            return True
+        
+        after_commit(partial(USER_CACHE.update, new_user_id, referred_by=referrer_id), new_user_id)
+        after_commit(partial(STATS_BUFFER.add, referrer_id, {'referrals_count': 1}))
+        after_commit(partial(remember_premium, referrer_id, premium), referrer_id)
+        return True
     except Exception as e:
         logger.error(f"Error in process_referral: {e}")
         return False
 
 
-def reset_daily_limit(user_id: int):
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            today = datetime.now().strftime("%Y-%m-%d")
-            cursor.execute("SELECT last_reset FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            if result and result[0] != today:
-                cursor.execute("UPDATE users SET free_questions = 5, last_reset = ? WHERE user_id = ?", (today, user_id))
-    except Exception as e:
-        logger.error(f"Error in reset_daily_limit: {e}")
+def reserve_question(user_id: int) -> tuple | None:
+    """Сброс дневного лимита и списание бесплатного вопроса одним UPDATE ... RETURNING.
+    
+    Premium проверяется до вызова (PREMIUM). None — лимит исчерпан; иначе (осталось вопросов, дата сброса).
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_RESERVE_QUESTION, {'user_id': user_id, 'daily': FREE_QUESTIONS_PER_DAY})
+        row = cursor.fetchone()
+    
+    if row is None:
+        return None
+    after_commit(partial(USER_CACHE.update, user_id, free_questions=row[0], last_reset=row[1]), user_id)
+    return row[0], row[1]
 
 
-def can_ask_question(user_id: int) -> tuple:
-    reset_daily_limit(user_id)
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT is_premium, premium_until, free_questions FROM users WHERE user_id = ?", (user_id,))
-            row = cursor.fetchone()
-            
-            if not row:
-                return False, 0
-            
-            is_prem, premium_until, free_q = row
-            
-            if is_prem and premium_until:
-                if datetime.now().date() <= datetime.strptime(premium_until, "%Y-%m-%d").date():
-                    return True, -1
-            
-            return free_q > 0, free_q
-    except Exception as e:
-        logger.error(f"Error in can_ask_question: {e}")
-        return False, 0
+def refund_question(user_id: int) -> int | None:
+    """Возвращает списанный сегодня вопрос (например, если AI не ответил)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_REFUND_QUESTION, (user_id, FREE_QUESTIONS_PER_DAY))
+        row = cursor.fetchone()
+    
+    if row is None:
+        return None
+    after_commit(partial(USER_CACHE.update, user_id, free_questions=row[0]), user_id)
+    return row[0]
 
 
-def use_question(user_id: int):
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET free_questions = free_questions - 1 WHERE user_id = ? AND free_questions > 0", (user_id,))
-            cursor.execute("UPDATE stats SET total_questions = total_questions + 1 WHERE user_id = ?", (user_id,))
-    except Exception as e:
-        logger.error(f"Error in use_question: {e}")
+def get_referral_code(user_id: int) -> str:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_REFERRAL_CODE, (user_id,))
+        return cursor.fetchone()[0]
 
 
-def is_premium(user_id: int) -> bool:
-    try:
+def get_user_stats(user_id: int) -> dict | None:
+    def query():
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT premium_until FROM users WHERE user_id = ?", (user_id,))
+            cursor.execute(SQL_USER_STATS, (user_id,))
             row = cursor.fetchone()
-            if not row or not row[0]:
-                return False
-            return datetime.now().date() <= datetime.strptime(row[0], "%Y-%m-%d").date()
-    except:
-        return False
+            columns = ['user_id', 'free_questions', 'is_premium', 'total_questions', 'workouts_completed']
+            return dict(zip(columns, row)) if row else None
+    
+    return STATS_BUFFER.read(query)
+
+
+def set_user_blocked(user_id: int, blocked: bool):
+    with db_connection() as conn:
+        conn.execute(SQL_SET_BLOCKED, (int(blocked), user_id))
 
 
 def activate_premium(user_id: int, days: int = 30):
     try:
         with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT premium_until FROM users WHERE user_id = ?", (user_id,))
-            current = cursor.fetchone()
-            
-            if current and current[0]:
-                base = max(datetime.now(), datetime.strptime(current[0], "%Y-%m-%d"))
-            else:
-                base = datetime.now()
-            
-            end = (base + timedelta(days=days)).strftime("%Y-%m-%d")
-            cursor.execute("UPDATE users SET is_premium = 1, premium_until = ? WHERE user_id = ?", (end, user_id))
+            premium = extend_premium(conn.cursor(), user_id, days)
             logger.info(f"Premium activated: {user_id} for {days} days")
+        if premium:
+            after_commit(partial(remember_premium, user_id, premium), user_id)
     except Exception as e:
         logger.error(f"Error in activate_premium: {e}")
 
 
 # ============================================================
-# === ПРОФИЛЬ ===
+# === КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ===
 # ============================================================
 
-def get_user_profile(user_id: int) -> dict:
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT height, weight, age, gender, goal, location, equipment, experience
-                FROM users WHERE user_id = ?
-            """, (user_id,))
-            row = cursor.fetchone()
-            
-            if not row:
-                return {}
-            
-            return {
-                'height': row[0], 'weight': row[1], 'age': row[2], 'gender': row[3],
-                'goal': row[4], 'location': row[5], 'equipment': row[6], 'experience': row[7]
-            }
-    except:
-        return {}
-
-
-def update_user_profile(user_id: int, **kwargs):
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            fields = [f"{k} = ?" for k, v in kwargs.items() if v is not None]
-            values = [v for v in kwargs.values() if v is not None]
-            
-            if fields:
-                values.append(user_id)
-                cursor.execute(f"UPDATE users SET {', '.join(fields)} WHERE user_id = ?", values)
-                logger.info(f"Profile updated: {user_id}")
-    except Exception as e:
-        logger.error(f"Error in update_user_profile: {e}")
-
-
-def has_profile(user_id: int) -> bool:
-    p = get_user_profile(user_id)
-    return bool(p.get('height') and p.get('weight') and p.get('goal'))
-
+# UPDATE изменённых полей строки users; {fields} — «колонка = ?» через запятую
+SQL_UPDATE_USER_FIELDS = "UPDATE users SET {fields} WHERE user_id = ?"
+SQL_SELECT_USER = f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = ?"
+SQL_INSERT_USER = f"""
+    INSERT INTO users (user_id, username, free_questions, last_reset, referral_code)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO NOTHING
+    RETURNING {', '.join(USER_COLUMNS)}
+"""
+SQL_INSERT_STATS = "INSERT OR IGNORE INTO stats (user_id) VALUES (?)"
+
+
+class UserContext:
+    """Строка пользователя, загруженная один раз на апдейт.
+    
+    Хендлеры и groq_chat читают данные отсюда, изменения копятся в памяти
+    и пишутся одной транзакцией в flush() в конце апдейта.
+    """
+    
+    def __init__(self, row: dict):
+        self.user_id = row['user_id']
+        self._row = row
+        self._dirty = {}
+        self._counters = {}
+        self._reserved = False
+        self._questions_left = -1
+    
+    def get(self, field: str, default=None):
+        value = self._row.get(field)
+        return default if value is None else value
+    
+    def set(self, **fields):
+        for field, value in fields.items():
+            if value is None or self._row.get(field) == value:
+                continue
+            self._row[field] = value
+            self._dirty[field] = value
+    
+    def refresh(self, **fields):
+        """Поля, уже записанные в БД: обновляет строку, не помечая их грязными"""
+        self._row.update(fields)
+    
+    @property
+    def dirty(self) -> bool:
+        """Есть изменённые поля users — нужен flush() через DB_WRITER"""
+        return bool(self._dirty)
+    
+    def incr(self, counter: str, amount: int = 1):
+        """Увеличивает счётчик в таблице stats: дельта уходит в STATS_BUFFER в flush_counters()"""
+        self._counters[counter] = self._counters.get(counter, 0) + amount
+    
+    @property
+    def is_premium(self) -> bool:
+        return PREMIUM.is_active(self.user_id)
+    
+    @property
+    def settings(self) -> dict:
+        return {'voice_mode': bool(self._row.get('voice_mode')), 'language': self._row.get('language') or 'ru'}
+    
+    @property
+    def profile(self) -> dict:
+        return {field: self._row.get(field) for field in PROFILE_FIELDS}
+    
+    def has_profile(self) -> bool:
+        return bool(self._row.get('height') and self._row.get('weight') and self._row.get('goal'))
+    
+    def set_voice_mode(self, enabled: bool):
+        self.set(voice_mode=1 if enabled else 0)
+        logger.info(f"Voice mode {'enabled' if enabled else 'disabled'}: {self.user_id}")
+    
+    def set_language(self, language: str):
+        if language not in ['ru', 'en', 'ko']:
+            language = 'ru'
+        self.set(language=language)
+        logger.info(f"Language set to {language}: {self.user_id}")
+    
+    async def reserve_question(self) -> tuple:
+        """Списывает вопрос сразу в БД: (можно ли спросить, сколько осталось; -1 для premium)"""
+        if self.is_premium:
+            self._questions_left = -1
+            return True, -1
+        
+        result = await db_write(reserve_question, self.user_id)
+        if result is None:
+            self._questions_left = 0
+            return False, 0
+        
+        remaining, last_reset = result
+        self.refresh(free_questions=remaining, last_reset=last_reset)
+        self._reserved = True
+        self._questions_left = remaining
+        self.incr('total_questions')
+        return True, remaining
+    
+    async def refund_question(self):
+        if not self._reserved:
+            return
+        self._reserved = False
+        remaining = await db_write(refund_question, self.user_id)
+        if remaining is not None:
+            self.refresh(free_questions=remaining)
+            self._questions_left = remaining
+            self.incr('total_questions', -1)
+    
+    @property
+    def questions_left(self) -> int:
+        """Остаток после reserve_question(); -1 — premium"""
+        return self._questions_left
+    
+    def flush_counters(self):
+        """Счётчики stats живут в памяти до STATS_BUFFER.flush — писатель тут не нужен"""
+        if self._counters:
+            counters, self._counters = self._counters, {}
+            STATS_BUFFER.add(self.user_id, counters)
+    
+    def flush(self):
+        """Выполняется в DB_WRITER: UPDATE изменённых полей users"""
+        if not self._dirty:
+            return
+        
+        dirty, self._dirty = self._dirty, {}
+        try:
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                fields = ", ".join(f"{k} = ?" for k in dirty)
+                cursor.execute(SQL_UPDATE_USER_FIELDS.format(fields=fields), (*dirty.values(), self.user_id))
+            after_commit(partial(USER_CACHE.update, self.user_id, **dirty), self.user_id)
+        except Exception as e:
+            USER_CACHE.invalidate(self.user_id)
+            logger.error(f"Error in UserContext.flush: {e}")
+
+
+def load_user_context(user_id: int) -> UserContext | None:
+    """Читает пользователя одним запросом; None — пользователя ещё нет (см. create_user)"""
+    since = USER_CACHE.begin_read()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_SELECT_USER, (user_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    
+    record = UserRecord(row)
+    USER_CACHE.put(record, since)
+    return UserContext(record.as_dict())
 
-# ============================================================
-# === НАСТРОЙКИ (Voice Mode / Language) ===
-# ============================================================
 
-def get_user_settings(user_id: int) -> dict:
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT voice_mode, language FROM users WHERE user_id = ?", (user_id,))
+def create_user(user_id: int, username: str = None) -> UserContext:
+    """Выполняется в DB_WRITER: INSERT ... RETURNING, строку в кэш — после COMMIT"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        today = datetime.now().strftime("%Y-%m-%d")
+        cursor.execute(SQL_INSERT_USER, (user_id, username, FREE_QUESTIONS_PER_DAY, today, generate_referral_code(user_id)))
+        row = cursor.fetchone()
+        
+        if row is not None:
+            cursor.execute(SQL_INSERT_STATS, (user_id,))
+            logger.info(f"New user: {user_id} (@{username})")
+        else:
+            # Параллельный апдейт успел создать пользователя
+            cursor.execute(SQL_SELECT_USER, (user_id,))
             row = cursor.fetchone()
-            
-            if row:
-                return {'voice_mode': bool(row[0]), 'language': row[1] or 'ru'}
-            return {'voice_mode': False, 'language': 'ru'}
-    except:
-        return {'voice_mode': False, 'language': 'ru'}
+    
+    record = UserRecord(row)
+    after_commit(partial(USER_CACHE.put, record), user_id)
+    return UserContext(record.as_dict())
 
 
-def set_voice_mode(user_id: int, enabled: bool):
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET voice_mode = ? WHERE user_id = ?", (1 if enabled else 0, user_id))
-            logger.info(f"Voice mode {'enabled' if enabled else 'disabled'}: {user_id}")
-    except Exception as e:
-        logger.error(f"Error in set_voice_mode: {e}")
+async def get_user_context(user_id: int, username: str = None) -> UserContext:
+    uctx = await db_call(load_user_context, user_id)
+    if uctx is None:
+        uctx = await db_write(create_user, user_id, username)
+    return uctx
 
 
-def set_user_language(user_id: int, language: str):
-    if language not in ['ru', 'en', 'ko']:
-        language = 'ru'
-    
-    try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET language = ? WHERE user_id = ?", (language, user_id))
-            logger.info(f"Language set to {language}: {user_id}")
-    except Exception as e:
-        logger.error(f"Error in set_user_language: {e}")
+def with_user_context(func):
+    """Загружает UserContext перед хендлером и сохраняет изменения после"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        user = update.effective_user
+        record = USER_CACHE.get(user.id)
+        if record is not None:
+            # Повторный визит: без обращения к БД и пулу потоков
+            uctx = UserContext(record.as_dict())
+        else:
+            uctx = await get_user_context(user.id, user.username)
+        try:
+            return await func(update, context, uctx, *args, **kwargs)
+        finally:
+            uctx.flush_counters()
+            if uctx.dirty:
+                await db_write(uctx.flush)
+    return wrapper
 
 
 # ============================================================
 # === ГЕНЕРАЦИЯ ГОЛОСА (edge-tts) ===
 # ============================================================
 
-async def generate_voice_response(text: str, user_id: int, lang: str = 'ru') -> str | None:
-    if not os.path.exists(VOICE_DIR):
-        os.makedirs(VOICE_DIR)
-    
-    voice = VOICE_MAP.get(lang, VOICE_MAP['ru'])
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_file = os.path.join(VOICE_DIR, f"voice_{user_id}_{timestamp}.ogg")
+async def generate_voice_response(clean_text: str, voice: str) -> bytes | None:
+    """Синтезирует речь в память: аудио-чанки edge-tts собираются в буфер"""
+    buffer = io.BytesIO()
     
     try:
-        if len(text) > 4000:
-            text = text[:4000] + "..."
-        
-        clean_text = clean_text_for_voice(text)
-        
         communicate = edge_tts.Communicate(clean_text, voice)
-        await communicate.save(output_file)
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                buffer.write(chunk["data"])
         
-        logger.info(f"Voice generated: {user_id}")
-        return output_file
+        if not buffer.tell():
+            return None
+        
+        logger.info(f"Voice generated: {buffer.tell()} bytes")
+        return buffer.getvalue()
     except Exception as e:
         logger.error(f"Voice generation failed: {e}")
         return None
 
 
+TTS_SEMAPHORE = asyncio.Semaphore(VOICE_TTS_WORKERS)
+SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+')
+
+
+def cut_at_word(text: str, limit: int) -> tuple:
+    """(начало не длиннее limit, остаток); режет по последнему пробелу, если он есть"""
+    if len(text) <= limit:
+        return text, ""
+    cut = text.rfind(' ', 0, limit + 1)
+    if cut <= 0:
+        cut = limit
+    return text[:cut].strip(), text[cut:].strip()
+
+
+def split_voice_text(clean_text: str) -> list:
+    """Режет текст на куски по границам предложений.
+    
+    Первый кусок не длиннее VOICE_FIRST_CHUNK_CHARS, чтобы первое голосовое пришло
+    быстрее; длинное первое предложение для этого режется по словам.
+    """
+    sentences = []
+    for sentence in SENTENCE_END_RE.split(clean_text):
+        while len(sentence) > VOICE_CHUNK_CHARS:
+            head, sentence = cut_at_word(sentence, VOICE_CHUNK_CHARS)
+            sentences.append(head)
+        if sentence:
+            sentences.append(sentence)
+    
+    if sentences and len(sentences[0]) > VOICE_FIRST_CHUNK_CHARS:
+        sentences[0:1] = cut_at_word(sentences[0], VOICE_FIRST_CHUNK_CHARS)
+    
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        limit = VOICE_FIRST_CHUNK_CHARS if not chunks else VOICE_CHUNK_CHARS
+        if current and len(current) + 1 + len(sentence) > limit:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def prepare_voice_text(text: str) -> str:
+    if len(text) > 4000:
+        text = text[:4000] + "..."
+    return clean_text_for_voice(text)
+
+
 def clean_text_for_voice(text: str) -> str:
     text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
     text = re.sub(r'\*(.+?)\*', r'\1', text)
@@ -812,42 +2090,181 @@ def clean_text_for_voice(text: str) -> str:
     return text.strip()
 
 
-def cleanup_voice_files(max_age_hours: int = 1):
-    if not os.path.exists(VOICE_DIR):
-        return
-    
-    now = datetime.now()
-    deleted = 0
+# ============================================================
+# === КЭШ ОЗВУЧКИ ===
+# ============================================================
+
+def voice_cache_key(clean_text: str, voice: str) -> str:
+    return hashlib.sha256(f"{voice}\n{clean_text}".encode()).hexdigest()
+
+
+def voice_cache_path(key: str) -> str:
+    return os.path.join(VOICE_CACHE_DIR, f"{key}.ogg")
+
+
+def write_voice_file(path: str, data: bytes):
+    part = f"{path}.part"
+    with open(part, 'wb') as f:
+        f.write(data)
+    os.replace(part, path)
+
+
+def read_voice_file(path: str) -> bytes | None:
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+SQL_GET_VOICE = "SELECT file_id, size FROM voice_cache WHERE hash = ?"
+SQL_TOUCH_VOICE = "UPDATE voice_cache SET last_used = ? WHERE hash = ?"
+SQL_SAVE_VOICE = """
+    INSERT INTO voice_cache (hash, file_id, size, last_used) VALUES (?, ?, ?, ?)
+    ON CONFLICT(hash) DO UPDATE SET file_id = excluded.file_id, size = excluded.size, last_used = excluded.last_used
+"""
+SQL_SAVE_VOICE_FILE = """
+    INSERT INTO voice_cache (hash, size, last_used) VALUES (?, ?, ?)
+    ON CONFLICT(hash) DO UPDATE SET size = excluded.size, last_used = excluded.last_used
+"""
+SQL_VOICE_CACHE_SIZE = "SELECT COALESCE(SUM(size), 0) FROM voice_cache"
+SQL_VOICE_FILES_LRU = "SELECT hash, size FROM voice_cache WHERE size > 0 ORDER BY last_used"
+SQL_EVICT_VOICE_FILE = "UPDATE voice_cache SET size = 0 WHERE hash = ?"
+SQL_DELETE_EMPTY_VOICE = "DELETE FROM voice_cache WHERE hash = ? AND file_id IS NULL"
+SQL_STALE_VOICE_FILES = "SELECT hash FROM voice_cache WHERE last_used < ? AND size > 0"
+SQL_DELETE_STALE_VOICE = "DELETE FROM voice_cache WHERE last_used < ?"
+SQL_VOICE_FILE_HASHES = "SELECT hash FROM voice_cache WHERE size > 0"
+
+
+def get_voice_cache(key: str) -> dict | None:
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_GET_VOICE, (key,))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute(SQL_TOUCH_VOICE, (int(time.time()), key))
+                return {'file_id': row[0], 'size': row[1]}
+    except Exception as e:
+        logger.error(f"Error in get_voice_cache: {e}")
+    return None
+
+
+def save_voice_file(key: str, size: int):
+    """Учитывает аудиофайл в voice_cache до записи на диск: файл без строки не вытеснялся бы никогда"""
+    with db_connection() as conn:
+        conn.execute(SQL_SAVE_VOICE_FILE, (key, size, int(time.time())))
+
+
+def save_voice_cache(key: str, file_id: str | None, size: int):
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_SAVE_VOICE, (key, file_id, size, int(time.time())))
+    except Exception as e:
+        logger.error(f"Error in save_voice_cache: {e}")
+
+
+def evict_voice_cache():
+    """LRU-вытеснение аудиофайлов сверх VOICE_CACHE_MAX_BYTES.
     
-    for filename in os.listdir(VOICE_DIR):
-        filepath = os.path.join(VOICE_DIR, filename)
-        if os.path.isfile(filepath):
-            age = now - datetime.fromtimestamp(os.path.getmtime(filepath))
-            if age.total_seconds() > max_age_hours * 3600:
-                try:
-                    os.remove(filepath)
-                    deleted += 1
-                except:
-                    pass
+    Записи с file_id остаются: по нему Telegram отправит голосовое без файла.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_VOICE_CACHE_SIZE)
+        total = cursor.fetchone()[0]
+        if total <= VOICE_CACHE_MAX_BYTES:
+            return
+        
+        cursor.execute(SQL_VOICE_FILES_LRU)
+        evicted = []
+        for key, size in cursor.fetchall():
+            if total <= VOICE_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(voice_cache_path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted.append((key,))
+        
+        cursor.executemany(SQL_EVICT_VOICE_FILE, evicted)
+        # Без file_id запись больше ни на что не указывает; удаляем по PK, а не сканом таблицы
+        cursor.executemany(SQL_DELETE_EMPTY_VOICE, evicted)
     
-    if deleted:
-        logger.info(f"Cleaned {deleted} voice files")
+    logger.info(f"Voice cache: evicted {len(evicted)} files")
+
+
+def prune_voice_cache():
+    """Удаляет записи (вместе с file_id и файлом), не использованные дольше VOICE_CACHE_TTL"""
+    cutoff = int(time.time()) - VOICE_CACHE_TTL
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_STALE_VOICE_FILES, (cutoff,))
+        for (key,) in cursor.fetchall():
+            try:
+                os.remove(voice_cache_path(key))
+            except FileNotFoundError:
+                pass
+        cursor.execute(SQL_DELETE_STALE_VOICE, (cutoff,))
+        if cursor.rowcount:
+            logger.info(f"Pruned {cursor.rowcount} stale voice cache rows")
+
 
+async def prune_voice_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    await db_write(prune_voice_cache)
 
-async def cleanup_voice_job(context: ContextTypes.DEFAULT_TYPE):
-    cleanup_voice_files(max_age_hours=1)
+
+def sweep_voice_cache_dir() -> int:
+    """При старте удаляет файлы кэша озвучки без строки в voice_cache и недописанные .part"""
+    with db_connection() as conn:
+        tracked = {f"{row[0]}.ogg" for row in conn.execute(SQL_VOICE_FILE_HASHES)}
+    
+    removed = 0
+    for name in os.listdir(VOICE_CACHE_DIR):
+        if name in tracked or not (name.endswith(".ogg") or name.endswith(".part")):
+            continue
+        try:
+            os.remove(os.path.join(VOICE_CACHE_DIR, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.info(f"Voice cache: removed {removed} untracked files")
+    return removed
 
 
 # ============================================================
 # === ПРОГРЕСС / НАПОМИНАНИЯ / ИСТОРИЯ ===
 # ============================================================
 
+SQL_ADD_WEIGHT = "INSERT INTO progress (user_id, weight) VALUES (?, ?)"
+SQL_SET_WEIGHT = "UPDATE users SET weight = ? WHERE user_id = ?"
+SQL_WEIGHT_HISTORY = "SELECT weight, date FROM progress WHERE user_id = ? ORDER BY date DESC LIMIT ?"
+SQL_ADD_WORKOUT = "INSERT INTO workouts (user_id, workout_text) VALUES (?, ?)"
+SQL_COMPLETE_WORKOUT = "UPDATE workouts SET completed = 1 WHERE id = ?"
+SQL_SET_REMINDER = "UPDATE users SET reminder_time = ?, reminder_days = ? WHERE user_id = ? RETURNING is_premium"
+SQL_USERS_WITH_REMINDERS = (
+    "SELECT user_id, reminder_time, reminder_days FROM users WHERE reminder_time IS NOT NULL AND is_premium = 1"
+)
+SQL_ADD_CHAT_MESSAGE = "INSERT INTO chat_history (user_id, role, content) VALUES (?, ?, ?)"
+SQL_TRIM_CHAT_HISTORY = """
+    DELETE FROM chat_history WHERE user_id = ? AND id <= (
+        SELECT id FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+    )
+"""
+SQL_CHAT_HISTORY = "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?"
+SQL_CLEAR_CHAT_HISTORY = "DELETE FROM chat_history WHERE user_id = ?"
+
+
 def add_weight_record(user_id: int, weight: float):
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("INSERT INTO progress (user_id, weight) VALUES (?, ?)", (user_id, weight))
-            cursor.execute("UPDATE users SET weight = ? WHERE user_id = ?", (weight, user_id))
+            cursor.execute(SQL_ADD_WEIGHT, (user_id, weight))
+            cursor.execute(SQL_SET_WEIGHT, (weight, user_id))
+        after_commit(partial(USER_CACHE.update, user_id, weight=weight), user_id)
     except Exception as e:
         logger.error(f"Error in add_weight_record: {e}")
 
@@ -856,17 +2273,34 @@ def get_weight_history(user_id: int, limit: int = 10) -> list:
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT weight, date FROM progress WHERE user_id = ? ORDER BY date DESC LIMIT ?", (user_id, limit))
+            cursor.execute(SQL_WEIGHT_HISTORY, (user_id, limit))
             return cursor.fetchall()
     except:
         return []
 
 
+def save_workout(user_id: int, workout_text: str) -> int:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_ADD_WORKOUT, (user_id, workout_text))
+        return cursor.lastrowid
+
+
+def complete_workout(workout_id: int):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_COMPLETE_WORKOUT, (workout_id,))
+
+
 def set_reminder(user_id: int, time_str: str, days: str):
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("UPDATE users SET reminder_time = ?, reminder_days = ? WHERE user_id = ?", (time_str, days, user_id))
+            cursor.execute(SQL_SET_REMINDER, (time_str, days, user_id))
+            row = cursor.fetchone()
+        after_commit(partial(USER_CACHE.update, user_id, reminder_time=time_str, reminder_days=days), user_id)
+        if row:
+            after_commit(partial(REMINDERS.update, user_id, time_str, days, bool(row[0])))
     except Exception as e:
         logger.error(f"Error in set_reminder: {e}")
 
@@ -875,33 +2309,34 @@ def get_users_with_reminders() -> list:
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT user_id, reminder_time, reminder_days FROM users WHERE reminder_time IS NOT NULL AND is_premium = 1")
+            cursor.execute(SQL_USERS_WITH_REMINDERS)
             return cursor.fetchall()
     except:
         return []
 
 
-def add_to_history(user_id: int, role: str, content: str):
+def save_chat_exchange(user_id: int, user_message: str, reply: str):
+    """Вопрос и ответ одной транзакцией; всё старше HISTORY_MAX_MESSAGES удаляется по диапазону id"""
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("INSERT INTO chat_history (user_id, role, content) VALUES (?, ?, ?)", (user_id, role, content[:2000]))
-            cursor.execute("""
-                DELETE FROM chat_history WHERE user_id = ? AND id NOT IN (
-                    SELECT id FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT 10
-                )
-            """, (user_id, user_id))
+            cursor.executemany(
+                SQL_ADD_CHAT_MESSAGE,
+                [(user_id, "user", user_message[:2000]), (user_id, "assistant", reply[:2000])]
+            )
+            cursor.execute(SQL_TRIM_CHAT_HISTORY, (user_id, user_id, HISTORY_MAX_MESSAGES))
     except Exception as e:
-        logger.error(f"Error in add_to_history: {e}")
+        logger.error(f"Error in save_chat_exchange: {e}")
 
 
-def get_chat_context(user_id: int, limit: int = 5) -> list:
+def load_chat_history(user_id: int) -> list:
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?", (user_id, limit))
+            cursor.execute(SQL_CHAT_HISTORY, (user_id, HISTORY_MAX_MESSAGES))
             return [{"role": r[0], "content": r[1]} for r in reversed(cursor.fetchall())]
-    except:
+    except Exception as e:
+        logger.error(f"Error in load_chat_history: {e}")
         return []
 
 
@@ -909,53 +2344,272 @@ def clear_history(user_id: int):
     try:
         with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+            cursor.execute(SQL_CLEAR_CHAT_HISTORY, (user_id,))
     except Exception as e:
         logger.error(f"Error in clear_history: {e}")
 
 
+class ChatHistoryCache:
+    """Последние HISTORY_MAX_MESSAGES сообщений активных пользователей в памяти (LRU по пользователям).
+    
+    Живёт только в event loop. Запись идёт сначала в БД, затем в кольцо, если
+    пользователь уже загружен; загрузка из БД не кладёт в кэш снимок, если
+    пока она шла, этот же пользователь успел записать новый обмен.
+    """
+    
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._rings = OrderedDict()
+        # user_id -> [загрузок в полёте, поколение записей] — только пока идёт загрузка
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+    
+    async def get(self, user_id: int, limit: int = 5) -> list:
+        ring = self._rings.get(user_id)
+        if ring is not None:
+            self._rings.move_to_end(user_id)
+            self.hits += 1
+        else:
+            self.misses += 1
+            loading = self._loading.setdefault(user_id, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+            try:
+                history = await db_call(load_chat_history, user_id)
+            finally:
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[user_id]
+            ring = self._rings.get(user_id)
+            if ring is None:
+                ring = deque(history, maxlen=HISTORY_MAX_MESSAGES)
+                if generation == loading[1]:
+                    self._store(user_id, ring)
+        return list(ring)[-limit:]
+    
+    async def add_exchange(self, user_id: int, user_message: str, reply: str):
+        await db_write(save_chat_exchange, user_id, user_message, reply)
+        ring = self._rings.get(user_id)
+        if ring is None:
+            self._invalidate_loads(user_id)
+            return
+        ring.append({"role": "user", "content": user_message[:2000]})
+        ring.append({"role": "assistant", "content": reply[:2000]})
+    
+    async def clear(self, user_id: int):
+        self._rings.pop(user_id, None)
+        self._invalidate_loads(user_id)
+        await db_write(clear_history, user_id)
+    
+    def _invalidate_loads(self, user_id: int):
+        loading = self._loading.get(user_id)
+        if loading:
+            loading[1] += 1
+    
+    def _store(self, user_id: int, ring: deque):
+        self._rings[user_id] = ring
+        while len(self._rings) > self.max_users:
+            self._rings.popitem(last=False)
+
+
+CHAT_HISTORY = ChatHistoryCache(HISTORY_CACHE_USERS)
+
+
 # ============================================================
 # === ПОИСК УПРАЖНЕНИЙ ===
 # ============================================================
 
-def find_exercise_in_db(query: str) -> dict | None:
-    try:
+RU_ENDINGS = sorted([
+    "иями", "ями", "ами", "ией", "иях", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ий", "ый", "ой", "ая", "яя", "ое", "ее", "ые", "ие", "ия", "ья", "ью", "ов", "ев",
+    "ам", "ям", "ах", "ях", "ом", "ем", "ую", "юю", "ей",
+    "ы", "и", "а", "я", "у", "ю", "е", "о", "ь", "й",
+], key=len, reverse=True)
+EXERCISE_MATCH_THRESHOLD = 0.5
+EXERCISE_QUERY_MAX_WORDS = 6
+# Слова-связки в запросе («как правильно делать упражнение ...»), которые не обязаны совпадать с названием
+EXERCISE_STOP_WORDS = ("как", "правильно", "делать", "выполнять", "выполнение", "техника", "упражнение")
+
+
+def normalize_exercise_text(text: str) -> str:
+    text = text.lower().replace('ё', 'е')
+    return re.sub(r'[^0-9a-zа-я]+', ' ', text).strip()
+
+
+@lru_cache(maxsize=50000)
+def stem_word(word: str) -> str:
+    """Грубый стеммер: отрезает падежное окончание (приседаний/приседания -> приседан)"""
+    if word.isascii():
+        return word[:-1] if len(word) > 3 and word.endswith('s') else word
+    for ending in RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def stem_phrase(text: str) -> tuple:
+    return tuple(stem_word(word) for word in normalize_exercise_text(text).split())
+
+
+def trigrams(word: str) -> set:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bitmask(ids: list, size: int) -> int:
+    bits = bytearray((size + 7) // 8)
+    for i in ids:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, 'little')
+
+
+SQL_EXERCISE_CATALOG = (
+    "SELECT id, name, aliases, description, muscles, gif_url, video_url, image_url, gif_file_id FROM exercises ORDER BY id"
+)
+SQL_EXERCISES_LIST = "SELECT name, muscles FROM exercises LIMIT ?"
+
+
+class ExerciseIndex:
+    """Индекс каталога упражнений в памяти: названия и синонимы разбиты на стеммы слов.
+    
+    Для каждого слова словаря хранится битовая маска терминов (int), где оно
+    встречается; термины пронумерованы по возрастанию числа слов, поэтому
+    младший бит пересечения масок — самое короткое подходящее название.
+    Строится при старте (reload) и подменяется целиком, поиск идёт без блокировок.
+    """
+    
+    def __init__(self):
+        self._index = None
+    
+    def reload(self):
         with db_connection() as conn:
             cursor = conn.cursor()
-            q = query.lower().strip()
-            
-            cursor.execute("SELECT name, description, muscles, gif_url, video_url, image_url FROM exercises WHERE LOWER(name) = ?", (q,))
-            row = cursor.fetchone()
-            
-            if not row:
-                cursor.execute("SELECT name, description, muscles, gif_url, video_url, image_url FROM exercises WHERE LOWER(aliases) LIKE ?", (f"%{q}%",))
-                row = cursor.fetchone()
-            
-            if not row:
-                cursor.execute("SELECT name, description, muscles, gif_url, video_url, image_url FROM exercises WHERE LOWER(name) LIKE ?", (f"%{q}%",))
-                row = cursor.fetchone()
+            cursor.execute(SQL_EXERCISE_CATALOG)
+            rows = cursor.fetchall()
+        self.build(rows)
+    
+    def build(self, rows):
+        """Строит индекс по строкам SQL_EXERCISE_CATALOG"""
+        entries = []
+        terms = []
+        for row in rows:
+            entries.append({
+                'id': row[0], 'name': row[1], 'description': row[3], 'muscles': row[4],
+                'gif_url': row[5], 'video_url': row[6], 'image_url': row[7], 'gif_file_id': row[8]
+            })
+            for term in [row[1]] + (row[2] or "").split(','):
+                stems = stem_phrase(term)
+                if stems:
+                    terms.append((len(stems), len(entries) - 1, stems))
+        terms.sort(key=lambda t: (t[0], t[1]))
+        
+        exact = {}
+        postings = {}
+        for term_id, (_, entry_id, stems) in enumerate(terms):
+            exact.setdefault(stems, entry_id)
+            for stem in set(stems):
+                postings.setdefault(stem, []).append(term_id)
+        
+        vocab = sorted(postings)
+        masks = {stem: bitmask(ids, len(terms)) for stem, ids in postings.items()}
+        vocab_grams = {}
+        for stem in vocab:
+            for gram in trigrams(stem):
+                vocab_grams.setdefault(gram, []).append(stem)
+        
+        term_entries = [entry_id for _, entry_id, _ in terms]
+        self._index = (entries, exact, term_entries, vocab, masks, vocab_grams)
+        logger.info(f"Exercise index: {len(entries)} exercises, {len(terms)} terms, {len(vocab)} words")
+    
+    def entries(self) -> list:
+        if self._index is None:
+            self.reload()
+        return self._index[0]
+    
+    def set_gif_file_id(self, exercise_id: int, file_id: str):
+        for entry in self.entries():
+            if entry['id'] == exercise_id:
+                entry['gif_file_id'] = file_id
+    
+    def _word_mask(self, stem: str) -> int:
+        """Маска терминов со словом, совпадающим со stem точно, по префиксу или по триграммам"""
+        _, _, _, vocab, masks, vocab_grams = self._index
+        mask = masks.get(stem, 0)
+        
+        if len(stem) >= 3:
+            i = bisect.bisect_left(vocab, stem)
+            while i < len(vocab) and vocab[i].startswith(stem):
+                mask |= masks[vocab[i]]
+                i += 1
             
-            if row:
-                return {'name': row[0], 'description': row[1], 'muscles': row[2], 'gif_url': row[3], 'video_url': row[4], 'image_url': row[5]}
-    except:
-        pass
-    return None
+            query_grams = trigrams(stem)
+            shared = {}
+            for gram in query_grams:
+                for word in vocab_grams.get(gram, ()):
+                    shared[word] = shared.get(word, 0) + 1
+            for word, count in shared.items():
+                if 2 * count / (len(query_grams) + len(word) + 2) >= EXERCISE_MATCH_THRESHOLD:
+                    mask |= masks[word]
+        
+        return mask
+    
+    def search(self, query: str) -> dict | None:
+        if self._index is None:
+            self.reload()
+        entries, exact, term_entries, _, _, _ = self._index
+        
+        stems = stem_phrase(query)[:EXERCISE_QUERY_MAX_WORDS]
+        if not stems:
+            return None
+        
+        entry_id = exact.get(stems)
+        if entry_id is not None:
+            return entries[entry_id]
+        
+        # Предлоги и союзы («на», «в», «с») и слова-связки не участвуют в нечётком поиске;
+        # остальные слова должны совпасть все: «жим ногами» не должен найти «Жим лёжа»
+        stems = [stem for stem in stems if len(stem) >= 3 and stem not in EXERCISE_STOP_STEMS]
+        if not stems:
+            return None
+        
+        mask = -1
+        for stem in stems:
+            mask &= self._word_mask(stem)
+            if not mask:
+                return None
+        
+        term_id = (mask & -mask).bit_length() - 1
+        return entries[term_entries[term_id]]
 
 
-async def search_exercise_gif(query: str) -> str | None:
-    if not GIPHY_API_KEY:
-        return None
-    
+EXERCISE_STOP_STEMS = frozenset(stem_word(word) for word in EXERCISE_STOP_WORDS)
+EXERCISE_INDEX = ExerciseIndex()
+
+
+def find_exercise_in_db(query: str) -> dict | None:
     try:
-        async with aiohttp.ClientSession() as session:
-            params = {"api_key": GIPHY_API_KEY, "q": f"{query} exercise fitness", "limit": 3, "rating": "g"}
-            async with session.get("https://api.giphy.com/v1/gifs/search", params=params, timeout=10) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data["data"]:
-                        return data["data"][0]["images"]["downsized_medium"]["url"]
+        return EXERCISE_INDEX.search(query)
     except Exception as e:
-        logger.error(f"Giphy error: {e}")
+        logger.error(f"Error in find_exercise_in_db: {e}")
+        return None
+
+
+def get_exercises_list(limit: int = 15) -> list:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_EXERCISES_LIST, (limit,))
+        return cursor.fetchall()
+
+
+async def search_exercise_gif(query: str) -> str | None:
+    """URL гифки или None, если Giphy ничего не нашёл; ошибки сети/API пробрасываются"""
+    params = {"api_key": GIPHY_API_KEY, "q": f"{query} exercise fitness", "limit": 3, "rating": "g"}
+    async with HTTP.session.get("https://api.giphy.com/v1/gifs/search", params=params, timeout=10) as resp:
+        resp.raise_for_status()
+        data = await resp.json()
+        if data["data"]:
+            return data["data"][0]["images"]["downsized_medium"]["url"]
     return None
 
 
@@ -980,29 +2634,490 @@ def extract_exercise_name(text: str) -> str | None:
     return None
 
 
+SQL_GET_EXERCISE_MEDIA = (
+    "SELECT name, gif_url, video_url, found, fetched_at, gif_file_id FROM exercise_media WHERE query_norm = ?"
+)
+SQL_SAVE_EXERCISE_MEDIA = """
+    INSERT INTO exercise_media (query_norm, name, gif_url, video_url, found, fetched_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(query_norm) DO UPDATE SET
+        name = excluded.name, video_url = excluded.video_url,
+        gif_file_id = CASE WHEN gif_url IS excluded.gif_url THEN gif_file_id END,
+        gif_url = excluded.gif_url, found = excluded.found, fetched_at = excluded.fetched_at
+"""
+SQL_SET_EXERCISE_GIF = "UPDATE exercises SET gif_file_id = ? WHERE id = ?"
+SQL_SET_MEDIA_GIF = "UPDATE exercise_media SET gif_file_id = ? WHERE query_norm = ?"
+
+
+def get_exercise_media(query_norm: str) -> dict | None:
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_GET_EXERCISE_MEDIA, (query_norm,))
+            row = cursor.fetchone()
+            if row:
+                return {
+                    'name': row[0], 'gif_url': row[1], 'video_url': row[2], 'found': bool(row[3]),
+                    'fetched_at': row[4], 'gif_file_id': row[5]
+                }
+    except Exception as e:
+        logger.error(f"Error in get_exercise_media: {e}")
+    return None
+
+
+def save_exercise_media(query_norm: str, name: str, gif_url: str | None, video_url: str):
+    try:
+        with db_connection() as conn:
+            conn.execute(SQL_SAVE_EXERCISE_MEDIA, (query_norm, name, gif_url, video_url, int(bool(gif_url)), int(time.time())))
+    except Exception as e:
+        logger.error(f"Error in save_exercise_media: {e}")
+
+
+def save_gif_file_id(exercise_id: int | None, query_norm: str | None, file_id: str):
+    try:
+        with db_connection() as conn:
+            if exercise_id is not None:
+                conn.execute(SQL_SET_EXERCISE_GIF, (file_id, exercise_id))
+            else:
+                conn.execute(SQL_SET_MEDIA_GIF, (file_id, query_norm))
+    except Exception as e:
+        logger.error(f"Error in save_gif_file_id: {e}")
+
+
+async def remember_gif_file_id(ex_data: dict, sent):
+    """Запоминает file_id отправленной гифки: дальше Telegram не будет скачивать её с giphy.com"""
+    media = sent and (sent.animation or sent.document)
+    if not media or media.file_id == ex_data.get('gif_file_id'):
+        return
+    
+    ex_data['gif_file_id'] = media.file_id
+    if ex_data.get('source') == 'database':
+        EXERCISE_INDEX.set_gif_file_id(ex_data['id'], media.file_id)
+    await db_write(save_gif_file_id, ex_data.get('id') if ex_data.get('source') == 'database' else None, ex_data.get('query_norm'), media.file_id)
+
+
+async def send_exercise_animation(message, ex_data: dict, **kwargs):
+    """reply_animation по file_id, а если Telegram его не принял — по URL"""
+    if ex_data.get('gif_file_id'):
+        try:
+            return await message.reply_animation(animation=ex_data['gif_file_id'], **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Cached GIF file_id rejected: {e}")
+            ex_data['gif_file_id'] = None
+    
+    sent = await message.reply_animation(animation=ex_data['gif_url'], **kwargs)
+    await remember_gif_file_id(ex_data, sent)
+    return sent
+
+
+async def prewarm_exercise_gifs(bot):
+    """Отправляет гифки каталога без file_id в служебный чат, запоминает file_id и удаляет сообщения"""
+    chat_id = MEDIA_CACHE_CHAT_ID or (ADMIN_IDS[0] if ADMIN_IDS else None)
+    if not chat_id:
+        return
+    
+    warmed = 0
+    for entry in [e for e in EXERCISE_INDEX.entries() if e['gif_url'] and not e['gif_file_id']]:
+        try:
+            sent = await bot.send_animation(
+                chat_id, entry['gif_url'], disable_notification=True, rate_limit_args=PRIORITY_BULK
+            )
+            await remember_gif_file_id({'source': 'database', **entry}, sent)
+            await bot.delete_message(chat_id, sent.message_id)
+            warmed += 1
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except (BadRequest, TimedOut) as e:
+            logger.warning(f"GIF prewarm failed for {entry['name']}: {e}")
+        except TelegramError as e:
+            logger.warning(f"GIF prewarm stopped: {e}")
+            break
+        await asyncio.sleep(1)
+    
+    if warmed:
+        logger.info(f"GIF prewarm: {warmed} file_ids cached")
+
+
+def media_is_fresh(media: dict) -> bool:
+    ttl = EXERCISE_MEDIA_TTL if media['found'] else EXERCISE_MEDIA_NEGATIVE_TTL
+    return time.time() - media['fetched_at'] < ttl
+
+
+async def discover_exercise_media(query: str, query_norm: str) -> dict | None:
+    """Ищет гифку в Giphy и запоминает результат, включая промах; при ошибке — None"""
+    try:
+        gif_url = await search_exercise_gif(query)
+    except Exception as e:
+        logger.error(f"Giphy error: {e}")
+        return None
+    
+    media = {
+        'name': query.title(), 'gif_url': gif_url, 'video_url': get_youtube_search_url(query),
+        'found': bool(gif_url), 'gif_file_id': None
+    }
+    await db_write(save_exercise_media, query_norm, media['name'], gif_url, media['video_url'])
+    return media
+
+
 async def get_exercise_with_media(query: str) -> dict:
     exercise = find_exercise_in_db(query)
     if exercise:
         return {'found': True, 'source': 'database', **exercise}
     
-    gif_url = await search_exercise_gif(query)
+    query_norm = " ".join(stem_phrase(query))
+    media = await db_call(get_exercise_media, query_norm) if query_norm else None
+    
+    if GIPHY_API_KEY and query_norm and not (media and media_is_fresh(media)):
+        # Устаревшая запись остаётся в ответе, если Giphy сейчас недоступен
+        media = await MEDIA_FLIGHTS.do(
+            query_norm, lambda publish: discover_exercise_media(query, query_norm)
+        ) or media
+    
     return {
-        'found': bool(gif_url),
+        'found': bool(media and media['found']),
         'source': 'search',
-        'name': query.title(),
-        'gif_url': gif_url,
-        'video_url': get_youtube_search_url(query),
+        'name': media['name'] if media else query.title(),
+        'gif_url': media['gif_url'] if media else None,
+        'gif_file_id': media['gif_file_id'] if media else None,
+        'query_norm': query_norm,
+        'video_url': media['video_url'] if media else get_youtube_search_url(query),
         'description': None,
         'muscles': None
     }
 
 
+# ============================================================
+# === КЭШ ОТВЕТОВ LLM ===
+# ============================================================
+
+def llm_cache_key(prompt: str, profile: dict) -> str:
+    """Ключ = нормализованный промпт + грубая корзина профиля из системного промпта"""
+    normalized = re.sub(r'\s+', ' ', prompt.lower()).strip()
+    
+    bucket = "-"
+    if profile.get('height'):
+        height = int(profile['height']) // 10 * 10
+        weight = int(profile['weight'] or 0) // 10 * 10
+        bucket = f"{height}/{weight}/{profile.get('goal') or ''}"
+    
+    return hashlib.sha1(f"{normalized}|{bucket}".encode()).hexdigest()
+
+
+SQL_GET_LLM_CACHE = "SELECT response FROM llm_cache WHERE cache_key = ? AND created_at > ?"
+SQL_ADD_LLM_CACHE = "INSERT INTO llm_cache (cache_key, response, created_at) VALUES (?, ?, ?)"
+SQL_TRIM_LLM_CACHE = "DELETE FROM llm_cache WHERE id <= ?"
+SQL_PRUNE_LLM_CACHE = "DELETE FROM llm_cache WHERE created_at <= ?"
+
+
+def get_cached_responses(cache_key: str) -> list:
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                SQL_GET_LLM_CACHE,
+                (cache_key, int(time.time()) - LLM_CACHE_TTL)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Error in get_cached_responses: {e}")
+        return []
+
+
+def add_cached_response(cache_key: str, response: str):
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                SQL_ADD_LLM_CACHE,
+                (cache_key, response, int(time.time()))
+            )
+            # AUTOINCREMENT id растёт монотонно — старше последних N строк можно удалять по PK
+            cursor.execute(SQL_TRIM_LLM_CACHE, (cursor.lastrowid - LLM_CACHE_MAX_ROWS,))
+    except Exception as e:
+        logger.error(f"Error in add_cached_response: {e}")
+
+
+def prune_llm_cache():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_PRUNE_LLM_CACHE, (int(time.time()) - LLM_CACHE_TTL,))
+        if cursor.rowcount:
+            logger.info(f"Pruned {cursor.rowcount} expired LLM cache rows")
+
+
+async def prune_llm_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    await db_write(prune_llm_cache)
+
+
 # ============================================================
 # === GROQ API ===
 # ============================================================
 
-async def groq_chat(user_id: int, user_message: str, use_context: bool = True) -> str:
-    profile = get_user_profile(user_id)
+class SingleFlight:
+    """Склеивает одинаковые запросы в полёте: один вызов upstream, результат — всем ждущим"""
+    
+    def __init__(self):
+        self._inflight = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+    
+    async def do(self, key: str, factory, on_partial=None):
+        """factory(publish) выполняет запрос; publish(text) рассылает частичный текст всем ждущим"""
+        flight = self._inflight.get(key)
+        if flight is None:
+            listeners = []
+            
+            async def publish(text: str):
+                for listener in list(listeners):
+                    await listener(text)
+            
+            task = asyncio.create_task(factory(publish))
+            flight = (task, listeners)
+            self._inflight[key] = flight
+            task.add_done_callback(lambda t: self._finish(key, flight))
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+        
+        task, listeners = flight
+        if on_partial:
+            listeners.append(on_partial)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if on_partial in listeners:
+                listeners.remove(on_partial)
+    
+    def _finish(self, key: str, flight: tuple):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        task = flight[0]
+        if not task.cancelled():
+            # Помечаем исключение полученным, даже если все ждущие отменились
+            task.exception()
+    
+    def stats(self) -> dict:
+        return {'upstream': self.upstream_calls, 'coalesced': self.coalesced, 'in_flight': len(self._inflight)}
+
+
+GROQ_FLIGHTS = SingleFlight()
+# Поиск медиа для упражнения: одновременные вопросы про одно упражнение — один запрос в Giphy
+MEDIA_FLIGHTS = SingleFlight()
+
+
+class LLMGovernor:
+    """Token bucket на запросы и токены в минуту + очередь с приоритетами.
+    
+    Запрос получает слот, когда в обоих бакетах хватает места и не превышен
+    GROQ_MAX_CONCURRENCY; первыми обслуживаются premium и интерактивные запросы.
+    После 429 вся очередь стоит до истечения Retry-After.
+    """
+    
+    def __init__(self, rpm: int, tpm: int, max_concurrency: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self.throttled = 0
+    
+    @staticmethod
+    def estimate_tokens(payload: dict) -> int:
+        prompt = json.dumps(payload.get("messages", []), ensure_ascii=False)
+        return len(prompt) // 3 + payload.get("max_tokens", 0)
+    
+    @asynccontextmanager
+    async def slot(self, priority: int, cost: int):
+        """Ждёт слот; в yield-словарь можно записать total_tokens из ответа"""
+        cost = min(cost, self.tpm)
+        await self._acquire(priority, cost)
+        usage = {}
+        try:
+            yield usage
+        finally:
+            self._release(cost, usage.get('total_tokens'))
+    
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.throttled += 1
+        logger.warning(f"Groq rate limited, pausing queue for {seconds:.1f}s")
+    
+    def observe(self, headers):
+        """Подстраивает бакет токенов под x-ratelimit-remaining-tokens от Groq"""
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        if remaining and remaining.isdigit():
+            self._refill()
+            self._tokens = min(self._tokens, float(remaining))
+    
+    def stats(self) -> dict:
+        return {
+            'queue': sum(1 for *_, fut in self._queue if not fut.done()),
+            'in_flight': self._in_flight,
+            'paused': max(0.0, self._paused_until - time.monotonic()),
+            'throttled': self.throttled
+        }
+    
+    async def _acquire(self, priority: int, cost: int):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), cost, fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Слот уже выдан, но ждущий отменён — возвращаем его
+                self._release(cost, cost)
+            raise
+    
+    def _release(self, cost: int, actual_tokens: int | None):
+        self._in_flight -= 1
+        if actual_tokens is not None:
+            self._refill()
+            self._tokens = min(self.tpm, self._tokens + cost - actual_tokens)
+        self._dispatch()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+    
+    def _dispatch(self):
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+        
+        self._refill()
+        wait = None
+        
+        while self._queue:
+            _, _, cost, fut = self._queue[0]
+            if fut.done():
+                heapq.heappop(self._queue)
+                continue
+            
+            now = time.monotonic()
+            if now < self._paused_until:
+                wait = self._paused_until - now
+                break
+            if self._in_flight >= self.max_concurrency:
+                # Освободившийся слот снова вызовет _dispatch
+                break
+            if self._requests < 1 or self._tokens < cost:
+                wait = max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (cost - self._tokens) * 60 / self.tpm
+                )
+                break
+            
+            heapq.heappop(self._queue)
+            self._requests -= 1
+            self._tokens -= cost
+            self._in_flight += 1
+            fut.set_result(None)
+        
+        if wait is not None:
+            self._wakeup = asyncio.get_running_loop().call_later(max(wait, 0.01), self._dispatch)
+
+
+GROQ_GOVERNOR = LLMGovernor(GROQ_RPM, GROQ_TPM, GROQ_MAX_CONCURRENCY)
+
+
+async def read_groq_stream(resp: aiohttp.ClientResponse, on_partial, usage: dict = None) -> str:
+    """Читает SSE-поток chat/completions и отдаёт накопленный текст в on_partial.
+    
+    Последний чанк (stream_options.include_usage) несёт usage — total_tokens пишется в usage.
+    """
+    text = ""
+    async for raw in resp.content:
+        line = raw.decode('utf-8').strip()
+        if not line.startswith("data:"):
+            continue
+        
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        
+        event = json.loads(data)
+        # Groq кладёт usage и в стандартное поле, и в x_groq
+        chunk_usage = event.get("usage") or (event.get("x_groq") or {}).get("usage")
+        if chunk_usage and usage is not None:
+            usage['total_tokens'] = chunk_usage.get("total_tokens")
+        
+        choices = event.get("choices") or []
+        delta = choices[0].get("delta", {}).get("content") if choices else None
+        if delta:
+            text += delta
+            await on_partial(text)
+    
+    return text.strip()
+
+
+async def groq_complete(payload: dict, on_partial=None, timeout: int = 30, max_retries: int = 3,
+                        priority: int = PRIORITY_INTERACTIVE, on_reply=None) -> str:
+    """Запрос к chat/completions с ретраями через GROQ_GOVERNOR.
+    
+    Одинаковые запросы (модель, сообщения, параметры) в полёте делят один вызов.
+    Если первый запрос стримится, частичный текст получают все ждущие с on_partial.
+    on_reply(reply) выполняется один раз на вызов Groq — у того, кто открыл полёт.
+    """
+    key = hashlib.sha1(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
+    stream = on_partial is not None
+    cost = LLMGovernor.estimate_tokens(payload)
+    
+    async def _call(publish):
+        async def _request():
+            # Без include_usage стрим не сообщает расход, и слот списывал бы всю оценку
+            body = dict(payload, stream=True, stream_options={"include_usage": True}) if stream else payload
+            async with GROQ_GOVERNOR.slot(priority, cost) as usage:
+                async with HTTP.session.post(GROQ_URL, json=body, headers=headers, timeout=timeout) as resp:
+                    GROQ_GOVERNOR.observe(resp.headers)
+                    if resp.status == 429:
+                        retry_after = resp.headers.get("Retry-After", "")
+                        retry_after = float(retry_after) if retry_after.replace('.', '', 1).isdigit() else 5.0
+                        GROQ_GOVERNOR.pause(retry_after)
+                        raise RateLimited(retry_after)
+                    if resp.status != 200:
+                        raise aiohttp.ClientError(f"API error: {resp.status}")
+                    if stream:
+                        return await read_groq_stream(resp, publish, usage)
+                    data = await resp.json()
+                    usage['total_tokens'] = data.get("usage", {}).get("total_tokens")
+                    return data["choices"][0]["message"]["content"].strip()
+        
+        reply = await retry_async(_request, max_retries=max_retries, delay=2)
+        if on_reply and reply:
+            await on_reply(reply)
+        return reply
+    
+    return await GROQ_FLIGHTS.do(key, _call, on_partial)
+
+
+async def groq_chat(uctx: UserContext, user_message: str, use_context: bool = True, on_partial=None) -> str:
+    """Запрос к Groq. С on_partial ответ стримится и частичный текст передаётся в колбэк.
+    
+    Ответы на промпты без контекста (use_context=False) кэшируются в llm_cache:
+    пока вариантов меньше LLM_CACHE_VARIANTS, идём в Groq, дальше отдаём случайный.
+    """
+    user_id = uctx.user_id
+    profile = uctx.profile
+    
+    cache_key = None
+    if not use_context and LLM_CACHE_VARIANTS > 0:
+        cache_key = llm_cache_key(user_message, profile)
+        variants = await db_call(get_cached_responses, cache_key)
+        if len(variants) >= LLM_CACHE_VARIANTS:
+            reply = random.choice(variants)
+            await CHAT_HISTORY.add_exchange(user_id, user_message, reply)
+            return reply
     
     profile_text = ""
     if profile.get('height'):
@@ -1010,31 +3125,27 @@ async def groq_chat(user_id: int, user_message: str, use_context: bool = True) -
     
     messages = [{"role": "system", "content": SYSTEM_PROMPT + profile_text}]
     
-    if use_context and is_premium(user_id):
-        messages.extend(get_chat_context(user_id))
+    if use_context and uctx.is_premium:
+        messages.extend(await CHAT_HISTORY.get(user_id))
     
     messages.append({"role": "user", "content": user_message})
     
     payload = {"model": "llama-3.3-70b-versatile", "messages": messages, "max_tokens": 1000, "temperature": 0.7}
-    headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
-    
-    async def _request():
-        async with aiohttp.ClientSession() as session:
-            async with session.post(GROQ_URL, json=payload, headers=headers, timeout=30) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                raise aiohttp.ClientError(f"API error: {resp.status}")
     
     try:
-        reply = await retry_async(_request, max_retries=3, delay=2)
-        add_to_history(user_id, "user", user_message)
-        add_to_history(user_id, "assistant", reply)
+        priority = PRIORITY_PREMIUM if uctx.is_premium else PRIORITY_INTERACTIVE
+        # Ответ кэширует только сам вызов Groq: иначе каждый присоединившийся к полёту
+        # записал бы ту же строку и занял все LLM_CACHE_VARIANTS одним вариантом
+        store = partial(db_write, add_cached_response, cache_key) if cache_key else None
+        reply = await groq_complete(payload, on_partial=on_partial, priority=priority, on_reply=store)
+        await CHAT_HISTORY.add_exchange(user_id, user_message, reply)
         return reply
     except asyncio.TimeoutError:
+        await uctx.refund_question()
         return "⚠️ AI думает слишком долго. Попробуй ещё раз."
     except Exception as e:
         logger.error(f"Groq error: {e}")
+        await uctx.refund_question()
         return "⚠️ Ошибка AI. Попробуй через минуту."
 
 
@@ -1047,18 +3158,17 @@ async def upload_to_imgbb(photo_bytes: bytes) -> str | None:
         return None
     
     try:
-        async with aiohttp.ClientSession() as session:
-            data = {"key": IMGBB_API_KEY, "image": base64.b64encode(photo_bytes).decode()}
-            async with session.post(IMGBB_API_URL, data=data, timeout=30) as resp:
-                if resp.status == 200:
-                    return (await resp.json())["data"]["url"]
+        data = {"key": IMGBB_API_KEY, "image": base64.b64encode(photo_bytes).decode()}
+        async with HTTP.session.post(IMGBB_API_URL, data=data, timeout=30) as resp:
+            if resp.status == 200:
+                return (await resp.json())["data"]["url"]
     except Exception as e:
         logger.error(f"ImgBB error: {e}")
     return None
 
 
-async def analyze_photo(user_id: int, photo_url: str, caption: str = "") -> str:
-    profile = get_user_profile(user_id)
+async def analyze_photo(uctx: UserContext, photo_url: str, caption: str = "") -> str:
+    profile = uctx.profile
     profile_text = f" Цель: {profile['goal']}." if profile.get('goal') else ""
     
     messages = [
@@ -1070,13 +3180,9 @@ async def analyze_photo(user_id: int, photo_url: str, caption: str = "") -> str:
     ]
     
     payload = {"model": "llama-3.2-90b-vision-preview", "messages": messages, "max_tokens": 800, "temperature": 0.7}
-    headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(GROQ_URL, json=payload, headers=headers, timeout=60) as resp:
-                if resp.status == 200:
-                    return (await resp.json())["choices"][0]["message"]["content"].strip()
+        return await groq_complete(payload, timeout=60, max_retries=1, priority=PRIORITY_PREMIUM)
     except Exception as e:
         logger.error(f"Vision error: {e}")
     
@@ -1140,30 +3246,114 @@ async def send_response(update: Update, text: str, voice_mode: bool, language: s
         await update.message.reply_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
 
 
+class StreamingMessage:
+    """Показывает частичный ответ LLM редкими edit_text без Markdown.
+    
+    Одновременно выполняется не больше одного редактирования; финальный
+    Markdown-рендер делает вызывающий код после finish().
+    """
+    
+    def __init__(self, message, header: str = ""):
+        self.message = message
+        self.header = header
+        self._next_edit = 0.0
+        self._shown_len = 0
+        self._task = None
+    
+    async def update(self, text: str):
+        if self._task and not self._task.done():
+            return
+        if time.monotonic() < self._next_edit or len(text) - self._shown_len < STREAM_MIN_DELTA_CHARS:
+            return
+        
+        self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        self._shown_len = len(text)
+        self._task = asyncio.create_task(self._edit(f"{self.header}{text} ▌"[:4096]))
+    
+    async def _edit(self, text: str):
+        try:
+            await self.message.edit_text(text)
+        except RetryAfter as e:
+            self._next_edit = time.monotonic() + e.retry_after
+        except TelegramError as e:
+            logger.debug(f"Stream edit skipped: {e}")
+    
+    async def finish(self):
+        if self._task:
+            await self._task
+
+
+async def synthesize_voice_chunk(clean_text: str, voice: str, key: str) -> bytes | None:
+    """Аудио куска из файлового кэша или через edge-tts (не больше VOICE_TTS_WORKERS одновременно)"""
+    voice_file = voice_cache_path(key)
+    audio = await asyncio.to_thread(read_voice_file, voice_file)
+    if audio is not None:
+        return audio
+    
+    async with TTS_SEMAPHORE:
+        audio = await generate_voice_response(clean_text, voice)
+    if audio:
+        # Строка раньше файла: если отправка не удастся, файл всё равно учтён в лимите
+        try:
+            await db_write(save_voice_file, key, len(audio))
+        except Exception as e:
+            logger.error(f"Error in save_voice_file: {e}")
+            return audio
+        await asyncio.to_thread(write_voice_file, voice_file, audio)
+    return audio
+
+
 async def send_voice_response(update: Update, text: str, language: str, user_id: int) -> bool:
-    voice_file = None
+    """Отправляет озвучку по кускам: синтез идёт параллельно, голосовые уходят по порядку.
+    
+    Каждый кусок кэшируется отдельно (file_id или файл).
+    """
+    voice = VOICE_MAP.get(language, VOICE_MAP['ru'])
+    chunks = split_voice_text(prepare_voice_text(text))
+    if not chunks:
+        return False
+    
+    keys = [voice_cache_key(chunk, voice) for chunk in chunks]
+    tasks = {}
     
     try:
-        await update.message.chat.send_action("record_voice")
-        voice_file = await generate_voice_response(text, user_id, language)
+        cached = await asyncio.gather(*(db_write(get_voice_cache, key) for key in keys))
         
-        if not voice_file or not os.path.exists(voice_file):
-            return False
+        for chunk, key, entry in zip(chunks, keys, cached):
+            if not (entry and entry['file_id']):
+                tasks[key] = asyncio.create_task(synthesize_voice_chunk(chunk, voice, key))
+        
+        if tasks:
+            await update.message.chat.send_action("record_voice")
+        
+        for chunk, key, entry in zip(chunks, keys, cached):
+            if entry and entry['file_id']:
+                try:
+                    await update.message.reply_voice(voice=entry['file_id'])
+                    continue
+                except BadRequest as e:
+                    logger.warning(f"Cached voice file_id rejected: {e}")
+                    tasks[key] = asyncio.create_task(synthesize_voice_chunk(chunk, voice, key))
+            
+            audio = await tasks[key]
+            if not audio:
+                return False
+            
+            sent = await update.message.reply_voice(voice=audio)
+            await db_write(save_voice_cache, key, sent.voice.file_id if sent and sent.voice else None, len(audio))
         
-        with open(voice_file, 'rb') as audio:
-            await update.message.reply_voice(voice=audio)
+        if tasks:
+            await db_write(evict_voice_cache)
         
-        logger.info(f"Voice sent: {user_id}")
+        logger.info(f"Voice sent: {user_id}, {len(chunks)} part(s), {len(tasks)} synthesized")
         return True
     except Exception as e:
         logger.error(f"Voice send error: {e}")
         return False
-    finally:
-        if voice_file and os.path.exists(voice_file):
-            try:
-                os.remove(voice_file)
-            except:
-                pass
+    finally:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
 
 
 # ============================================================
@@ -1230,9 +3420,9 @@ def get_main_menu_keyboard(settings: dict) -> InlineKeyboardMarkup:
 # ============================================================
 
 @handle_errors
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user_context
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, uctx: UserContext):
     user = update.effective_user
-    get_or_create_user(user.id, user.username)
     
     logger.info(f"User {user.id} started bot")
     
@@ -1247,11 +3437,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # === РЕФЕРАЛ ===
     if context.args:
         ref_code = context.args[0]
-        if process_referral(user.id, ref_code):
+        if await db_write(process_referral, user.id, ref_code):
             await update.message.reply_text("🎁 Реферальный бонус начислен!")
     
     # === ГЛАВНОЕ МЕНЮ ===
-    settings = get_user_settings(user.id)
+    settings = uctx.settings
     
     await update.message.reply_text(
         f"💪 Привет, {user.first_name}!\n\n"
@@ -1264,7 +3454,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @handle_errors
-async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user_context
+async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE, uctx: UserContext):
     user_id = update.effective_user.id
     
     # Проверка подписки
@@ -1273,8 +3464,7 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_subscription_required(update)
             return
     
-    settings = get_user_settings(user_id)
-    await send_settings_menu(update.message, settings)
+    await send_settings_menu(update.message, uctx.settings)
 
 
 @handle_errors
@@ -1293,7 +3483,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @handle_errors
-async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user_context
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE, uctx: UserContext):
     user_id = update.effective_user.id
     
     # Проверка подписки
@@ -1302,14 +3493,14 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_subscription_required(update)
             return
     
-    p = get_user_profile(user_id)
+    p = uctx.profile
     
-    if not has_profile(user_id):
+    if not uctx.has_profile():
         keyboard = [[InlineKeyboardButton("👤 Создать профиль", callback_data="setup_profile")]]
         await update.message.reply_text("❌ Профиль не заполнен", reply_markup=InlineKeyboardMarkup(keyboard))
         return
     
-    prem = "💎 Premium" if is_premium(user_id) else "🆓 Free"
+    prem = "💎 Premium" if uctx.is_premium else "🆓 Free"
     
     await update.message.reply_text(
         f"👤 **Твой профиль** {prem}\n\n"
@@ -1325,10 +3516,7 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @handle_errors
 async def exercises_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name, muscles FROM exercises LIMIT 15")
-            exercises = cursor.fetchall()
+        exercises = await db_call(get_exercises_list, 15)
         
         lines = [f"• **{name}** — {muscles}" for name, muscles in exercises]
         await update.message.reply_text("🏋️ **Упражнения:**\n\n" + "\n".join(lines), parse_mode="Markdown")
@@ -1341,21 +3529,15 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT u.free_questions, u.is_premium, s.total_questions, s.workouts_completed
-                FROM users u LEFT JOIN stats s ON u.user_id = s.user_id WHERE u.user_id = ?
-            """, (user_id,))
-            row = cursor.fetchone()
+        row = await db_call(get_user_stats, user_id)
         
         if row:
-            status = "💎 Premium" if row[1] else f"🆓 Free ({row[0]}/5 вопросов)"
+            status = "💎 Premium" if row['is_premium'] else f"🆓 Free ({row['free_questions']}/5 вопросов)"
             await update.message.reply_text(
                 f"📊 **Твоя статистика**\n\n"
                 f"Статус: {status}\n"
-                f"💬 Вопросов задано: {row[2] or 0}\n"
-                f"💪 Тренировок выполнено: {row[3] or 0}",
+                f"💬 Вопросов задано: {row['total_questions'] or 0}\n"
+                f"💪 Тренировок выполнено: {row['workouts_completed'] or 0}",
                 parse_mode="Markdown"
             )
     except:
@@ -1364,7 +3546,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @handle_errors
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    clear_history(update.effective_user.id)
+    await CHAT_HISTORY.clear(update.effective_user.id)
     await update.message.reply_text("✅ История диалога очищена!")
 
 
@@ -1373,10 +3555,7 @@ async def referral_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT referral_code FROM users WHERE user_id = ?", (user_id,))
-            code = cursor.fetchone()[0]
+        code = await db_call(get_referral_code, user_id)
         
         bot_username = (await context.bot.get_me()).username
         
@@ -1395,9 +3574,9 @@ async def referral_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============================================================
 
 @handle_errors
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user_context
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, uctx: UserContext):
     user = update.effective_user
-    get_or_create_user(user.id, user.username)
     
     # === ПРОВЕРКА ПОДПИСКИ ===
     if CHECK_SUBSCRIPTION and user.id not in ADMIN_IDS:
@@ -1411,7 +3590,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Message from {user.id}: {text[:50]}...")
     
     # Настройки
-    settings = get_user_settings(user.id)
+    settings = uctx.settings
     voice_mode = settings.get('voice_mode', False)
     language = settings.get('language', 'ru')
     
@@ -1420,8 +3599,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if weight_match:
         w = float(weight_match.group(1))
         if 30 <= w <= 300:
-            add_weight_record(user.id, w)
-            history = get_weight_history(user.id, 2)
+            await db_write(add_weight_record, user.id, w)
+            uctx.refresh(weight=w)
+            history = await db_call(get_weight_history, user.id, 2)
             
             response = f"✅ Записано: **{w} кг**"
             if len(history) >= 2:
@@ -1436,7 +3616,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(re.findall(r'\d+', text)) >= 2 and any(w in text_lower for w in ['похуд', 'набр', 'дом', 'зал', 'форм']):
         data = parse_profile_message(text)
         if data.get('height') and data.get('weight'):
-            update_user_profile(user.id, **data)
+            uctx.set(**data)
+            logger.info(f"Profile updated: {user.id}")
             await send_response(update, "✅ **Профиль сохранён!**", voice_mode, language, user.id)
             return
     
@@ -1450,17 +3631,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 await update.message.chat.send_action("typing")
             
-            can_ask, _ = can_ask_question(user.id)
+            can_ask, _ = await uctx.reserve_question()
             if not can_ask:
                 keyboard = [[InlineKeyboardButton("💎 Premium", callback_data="subscribe")]]
                 await update.message.reply_text("⚠️ Лимит вопросов исчерпан!", reply_markup=InlineKeyboardMarkup(keyboard))
                 return
             
             ex_data = await get_exercise_with_media(ex_name)
-            ai_response = await groq_chat(user.id, f"Объясни технику '{ex_name}'. Кратко.", use_context=False)
-            
-            if not is_premium(user.id):
-                use_question(user.id)
+            ai_response = await groq_chat(uctx, f"Объясни технику '{ex_name}'. Кратко.", use_context=False)
             
             response_text = f"💪 **{ex_data['name']}**\n\n"
             if ex_data.get('muscles'):
@@ -1474,8 +3652,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # GIF + ответ
             if ex_data.get('gif_url'):
                 try:
-                    await update.message.reply_animation(
-                        animation=ex_data['gif_url'],
+                    await send_exercise_animation(
+                        update.message, ex_data,
                         caption=f"💪 {ex_data['name']}" if voice_mode else response_text[:1024],
                         parse_mode="Markdown",
                         reply_markup=InlineKeyboardMarkup(keyboard) if keyboard and not voice_mode else None
@@ -1493,7 +3671,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     
     # === ОБЫЧНЫЙ ВОПРОС ===
-    can_ask, _ = can_ask_question(user.id)
+    can_ask, _ = await uctx.reserve_question()
     if not can_ask:
         keyboard = [[InlineKeyboardButton("💎 Premium", callback_data="subscribe")]]
         await update.message.reply_text("⚠️ Лимит вопросов исчерпан!", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -1504,16 +3682,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.chat.send_action("typing")
     
-    response = await groq_chat(user.id, text)
-    
-    if not is_premium(user.id):
-        use_question(user.id)
+    response = await groq_chat(uctx, text)
     
     footer = ""
-    if not is_premium(user.id):
-        _, rem = can_ask_question(user.id)
-        if rem <= 2:
-            footer = f"\n\n💡 Осталось вопросов: {rem}/5"
+    rem = uctx.questions_left
+    if 0 <= rem <= 2:
+        footer = f"\n\n💡 Осталось вопросов: {rem}/{FREE_QUESTIONS_PER_DAY}"
     
     await send_response(update, response + footer, voice_mode, language, user.id)
 
@@ -1523,9 +3697,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============================================================
 
 @handle_errors
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user_context
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, uctx: UserContext):
     user = update.effective_user
-    get_or_create_user(user.id, user.username)
     
     # Проверка подписки
     if CHECK_SUBSCRIPTION and user.id not in ADMIN_IDS:
@@ -1533,12 +3707,12 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_subscription_required(update)
             return
     
-    if not is_premium(user.id) and user.id not in ADMIN_IDS:
+    if not uctx.is_premium and user.id not in ADMIN_IDS:
         keyboard = [[InlineKeyboardButton("🔥 Premium", callback_data="subscribe")]]
         await update.message.reply_text("📸 Анализ фото доступен в Premium!", reply_markup=InlineKeyboardMarkup(keyboard))
         return
     
-    settings = get_user_settings(user.id)
+    settings = uctx.settings
     
     if settings['voice_mode']:
         await update.message.chat.send_action("record_voice")
@@ -1554,7 +3728,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Не удалось загрузить фото")
         return
     
-    analysis = await analyze_photo(user.id, photo_url, update.message.caption or "")
+    analysis = await analyze_photo(uctx, photo_url, update.message.caption or "")
     
     await send_response(update, f"📸 **Анализ:**\n\n{analysis}", settings['voice_mode'], settings['language'], user.id)
 
@@ -1564,23 +3738,22 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============================================================
 
 @handle_errors
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user_context
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, uctx: UserContext):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
     
     # === ПРОВЕРКА ПОДПИСКИ ===
     if query.data == "check_subscription":
-        is_subscribed = await check_subscription(user_id, context)
+        is_subscribed = await check_subscription(user_id, context, force=True)
         
         if is_subscribed:
-            settings = get_user_settings(user_id)
-            
             await query.message.edit_text(
                 "✅ **Подписка подтверждена!**\n\n"
                 "💪 Добро пожаловать в **Murasaki Sport**!\n\n"
                 "Выбери действие или задай вопрос 👇",
-                reply_markup=get_main_menu_keyboard(settings),
+                reply_markup=get_main_menu_keyboard(uctx.settings),
                 parse_mode="Markdown"
             )
         else:
@@ -1589,28 +3762,23 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === ГЛАВНОЕ МЕНЮ ===
     if query.data == "main_menu":
-        settings = get_user_settings(user_id)
-        
         await query.message.edit_text(
             "💪 **Murasaki Sport**\n\n"
             "Выбери действие или задай вопрос 👇",
-            reply_markup=get_main_menu_keyboard(settings),
+            reply_markup=get_main_menu_keyboard(uctx.settings),
             parse_mode="Markdown"
         )
         return
     
     # === НАСТРОЙКИ ===
     if query.data == "settings":
-        settings = get_user_settings(user_id)
-        await send_settings_menu(query.message, settings, edit=True)
+        await send_settings_menu(query.message, uctx.settings, edit=True)
         return
     
     if query.data == "toggle_voice_mode":
-        settings = get_user_settings(user_id)
-        new_mode = not settings['voice_mode']
-        set_voice_mode(user_id, new_mode)
-        settings['voice_mode'] = new_mode
-        await send_settings_menu(query.message, settings, edit=True)
+        new_mode = not uctx.settings['voice_mode']
+        uctx.set_voice_mode(new_mode)
+        await send_settings_menu(query.message, uctx.settings, edit=True)
         await query.answer("🎙️ Голосовой режим включён!" if new_mode else "📝 Текстовый режим включён!", show_alert=True)
         return
     
@@ -1620,9 +3788,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if query.data.startswith("set_lang_"):
         lang = query.data.replace("set_lang_", "")
-        set_user_language(user_id, lang)
-        settings = get_user_settings(user_id)
-        await send_settings_menu(query.message, settings, edit=True)
+        uctx.set_language(lang)
+        await send_settings_menu(query.message, uctx.settings, edit=True)
         lang_names = {'ru': '🇷🇺 Русский', 'en': '🇺🇸 English', 'ko': '🇰🇷 한국어'}
         await query.answer(f"Язык: {lang_names.get(lang, lang)}", show_alert=True)
         return
@@ -1659,7 +3826,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === ТРЕНИРОВКА ===
     if query.data == "workout":
-        if not has_profile(user_id):
+        if not uctx.has_profile():
             keyboard = [[InlineKeyboardButton("👤 Создать профиль", callback_data="setup_profile")]]
             await query.message.reply_text("❌ Сначала создай профиль!", reply_markup=InlineKeyboardMarkup(keyboard))
             return
@@ -1675,18 +3842,17 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if query.data.startswith("workout_"):
         wtype = query.data.replace("workout_", "")
-        profile = get_user_profile(user_id)
+        profile = uctx.profile
         
         await query.message.edit_text("💪 Составляю тренировку...")
         
         types = {'strength': 'силовую', 'cardio': 'кардио', 'stretch': 'на растяжку'}
-        response = await groq_chat(user_id, f"Составь {types.get(wtype, '')} тренировку. Место: {profile.get('location', 'дом')}. Цель: {profile.get('goal', '')}.", use_context=False)
+        stream = StreamingMessage(query.message, "💪 Твоя тренировка:\n\n")
+        response = await groq_chat(uctx, f"Составь {types.get(wtype, '')} тренировку. Место: {profile.get('location', 'дом')}. Цель: {profile.get('goal', '')}.", use_context=False, on_partial=stream.update)
+        await stream.finish()
         
         try:
-            with db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO workouts (user_id, workout_text) VALUES (?, ?)", (user_id, response))
-                wid = cursor.lastrowid
+            wid = await db_write(save_workout, user_id, response)
             
             keyboard = [[InlineKeyboardButton("✅ Выполнено!", callback_data=f"complete_{wid}")]]
             await query.message.edit_text(f"💪 **Твоя тренировка:**\n\n{response}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
@@ -1697,10 +3863,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.data.startswith("complete_"):
         wid = int(query.data.replace("complete_", ""))
         try:
-            with db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE workouts SET completed = 1 WHERE id = ?", (wid,))
-                cursor.execute("UPDATE stats SET workouts_completed = workouts_completed + 1 WHERE user_id = ?", (user_id,))
+            await db_write(complete_workout, wid)
+            uctx.incr('workouts_completed')
         except:
             pass
         await query.answer("🔥 Отлично! Тренировка записана!", show_alert=True)
@@ -1721,21 +3885,18 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if query.data.startswith("recipe_"):
         rtype = query.data.replace("recipe_", "")
-        profile = get_user_profile(user_id)
+        profile = uctx.profile
         
         types = {'breakfast': 'завтрак', 'lunch': 'обед', 'dinner': 'ужин', 'snack': 'перекус'}
         
         await query.message.edit_text("🍽️ Подбираю рецепт...")
         
         goal_text = f"Цель: {profile.get('goal', 'здоровое питание')}." if profile.get('goal') else ""
-        response = await groq_chat(user_id, f"Дай рецепт на {types.get(rtype, 'блюдо')}. {goal_text} С КБЖУ.", use_context=False)
+        stream = StreamingMessage(query.message, "🍽️ Рецепт:\n\n")
+        response = await groq_chat(uctx, f"Дай рецепт на {types.get(rtype, 'блюдо')}. {goal_text} С КБЖУ.", use_context=False, on_partial=stream.update)
+        await stream.finish()
         
-        try:
-            with db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE stats SET recipes_generated = recipes_generated + 1 WHERE user_id = ?", (user_id,))
-        except:
-            pass
+        uctx.incr('recipes_generated')
         
         keyboard = [[InlineKeyboardButton("🔄 Другой рецепт", callback_data="recipe")]]
         await query.message.edit_text(f"🍽️ **Рецепт:**\n\n{response}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
@@ -1743,7 +3904,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # === ПРОГРЕСС ===
     if query.data == "progress":
-        records = get_weight_history(user_id, 10)
+        records = await db_call(get_weight_history, user_id, 10)
         
         if not records:
             await query.message.reply_text(
@@ -1809,10 +3970,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if query.data == "referral_info":
         try:
-            with db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT referral_code FROM users WHERE user_id = ?", (user_id,))
-                code = cursor.fetchone()[0]
+            code = await db_call(get_referral_code, user_id)
             
             bot_username = (await context.bot.get_me()).username
             
@@ -1839,7 +3997,7 @@ async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 @handle_errors
 async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    activate_premium(user_id)
+    await db_write(activate_premium, user_id)
     
     logger.info(f"Payment successful: {user_id}")
     
@@ -1858,21 +4016,438 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # === НАПОМИНАНИЯ ===
 # ============================================================
 
+WEEKDAYS = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+
+def minute_of_week(moment: datetime) -> int:
+    return moment.weekday() * 1440 + moment.hour * 60 + moment.minute
+
+
+class ReminderScheduler:
+    """Напоминания по корзинам «минута недели» -> user_id.
+    
+    Заполняется из БД при старте и дальше меняется точечно из set_reminder и
+    при выдаче premium; тик обходит только наступившие минуты, а не всех
+    пользователей. Вызывается и из потоков БД, поэтому под блокировкой.
+    """
+    
+    def __init__(self):
+        self._buckets = {}
+        self._slots = {}
+        self._last_minute = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def parse(reminder_time: str | None, reminder_days: str | None) -> list:
+        if not reminder_time or not reminder_days:
+            return []
+        try:
+            hour, minute = map(int, reminder_time.split(':'))
+        except ValueError:
+            return []
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            return []
+        return [day * 1440 + hour * 60 + minute for day, name in enumerate(WEEKDAYS) if name in reminder_days]
+    
+    def update(self, user_id: int, reminder_time: str | None, reminder_days: str | None, is_premium: bool = True):
+        slots = self.parse(reminder_time, reminder_days) if is_premium else []
+        with self._lock:
+            for slot in self._slots.pop(user_id, []):
+                bucket = self._buckets.get(slot)
+                if bucket:
+                    bucket.discard(user_id)
+                    if not bucket:
+                        del self._buckets[slot]
+            if slots:
+                self._slots[user_id] = slots
+                for slot in slots:
+                    self._buckets.setdefault(slot, set()).add(user_id)
+    
+    def remove(self, user_id: int):
+        self.update(user_id, None, None)
+    
+    def load(self):
+        rows = get_users_with_reminders()
+        with self._lock:
+            self._buckets.clear()
+            self._slots.clear()
+        for user_id, reminder_time, reminder_days in rows:
+            self.update(user_id, reminder_time, reminder_days)
+        logger.info(f"Reminders loaded: {len(self._slots)} users")
+    
+    def due(self, now: datetime) -> list:
+        """Пользователи всех минут с прошлого тика по текущую (после задержки тика — не больше 5 минут)"""
+        current = minute_of_week(now)
+        with self._lock:
+            last = self._last_minute
+            self._last_minute = current
+            if last is None or last == current:
+                minutes = [current] if last is None else []
+            else:
+                gap = min((current - last) % MINUTES_PER_WEEK, 5)
+                minutes = [(current - i) % MINUTES_PER_WEEK for i in range(gap - 1, -1, -1)]
+            
+            users = []
+            for minute in minutes:
+                users.extend(self._buckets.get(minute, ()))
+            return users
+    
+    def __len__(self):
+        return len(self._slots)
+
+
+REMINDERS = ReminderScheduler()
+
+
+async def send_reminder(bot, user_id: int) -> bool:
+    try:
+        await bot.send_message(
+            user_id,
+            "⏰ **Время тренировки!** 💪\n\nГотов начать?",
+            parse_mode="Markdown",
+            rate_limit_args=PRIORITY_BACKGROUND
+        )
+        return True
+    except TelegramError:
+        return False
+
+
 async def check_reminders(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
-    current_time = now.strftime("%H:%M")
-    current_day = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс'][now.weekday()]
+    due = REMINDERS.due(datetime.now())
+    if not due:
+        return
     
-    for user_id, reminder_time, reminder_days in get_users_with_reminders():
-        if reminder_time == current_time and current_day in reminder_days:
-            try:
-                await context.bot.send_message(
-                    user_id, 
-                    "⏰ **Время тренировки!** 💪\n\nГотов начать?",
-                    parse_mode="Markdown"
+    sent = 0
+    # Пачки по REMINDER_SEND_RATE параллельно; темп задаёт OUTBOUND с фоновым приоритетом
+    for i in range(0, len(due), REMINDER_SEND_RATE):
+        results = await asyncio.gather(*(send_reminder(context.bot, uid) for uid in due[i:i + REMINDER_SEND_RATE]))
+        sent += sum(results)
+    
+    logger.info(f"Reminders sent: {sent}/{len(due)}")
+
+
+# ============================================================
+# === РАССЫЛКИ ===
+# ============================================================
+
+BROADCAST_COLUMNS = ["id", "text", "admin_chat_id", "status", "total", "last_user_id", "sent", "failed", "blocked"]
+SQL_COUNT_RECIPIENTS = "SELECT COUNT(*) FROM users WHERE blocked = 0"
+SQL_CREATE_BROADCAST = (
+    f"INSERT INTO broadcasts (text, admin_chat_id, total) VALUES (?, ?, ?) RETURNING {', '.join(BROADCAST_COLUMNS)}"
+)
+SQL_LAST_BROADCAST = f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcasts ORDER BY id DESC LIMIT 1"
+SQL_GET_BROADCAST = f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcasts WHERE id = ?"
+SQL_RUNNING_BROADCASTS = f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcasts WHERE status = 'running'"
+SQL_BROADCAST_RECIPIENTS = "SELECT user_id FROM users WHERE blocked = 0 AND user_id > ? ORDER BY user_id LIMIT ?"
+SQL_BROADCAST_PROGRESS = (
+    "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE id = ?"
+)
+SQL_MARK_BLOCKED = "UPDATE users SET blocked = 1 WHERE user_id = ?"
+SQL_BROADCAST_STATUS = (
+    "UPDATE broadcasts SET status = ?, finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END WHERE id = ?"
+)
+# id -> статус; задача рассылки сверяется с ним перед каждой пачкой
+BROADCAST_STATE = {}
+# Задачи рассылок живут вне Application.create_task: иначе stop() ждал бы конца рассылки.
+# Курсор сохранён в БД, поэтому при остановке их просто отменяем (stop_broadcasts в post_stop)
+BROADCAST_TASKS = set()
+
+
+def create_broadcast(text: str, admin_chat_id: int) -> dict:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_COUNT_RECIPIENTS)
+        total = cursor.fetchone()[0]
+        cursor.execute(SQL_CREATE_BROADCAST, (text, admin_chat_id, total))
+        return dict(zip(BROADCAST_COLUMNS, cursor.fetchone()))
+
+
+def get_broadcast(broadcast_id: int | None = None) -> dict | None:
+    """Рассылка по id, а без id — последняя"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if broadcast_id is None:
+            cursor.execute(SQL_LAST_BROADCAST)
+        else:
+            cursor.execute(SQL_GET_BROADCAST, (broadcast_id,))
+        row = cursor.fetchone()
+        return dict(zip(BROADCAST_COLUMNS, row)) if row else None
+
+
+def get_running_broadcasts() -> list:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_RUNNING_BROADCASTS)
+        return [dict(zip(BROADCAST_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def next_broadcast_recipients(after_user_id: int, limit: int) -> list:
+    """Следующие получатели по keyset-курсору: WHERE user_id > последний отправленный"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_BROADCAST_RECIPIENTS, (after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked_ids: list):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            SQL_BROADCAST_PROGRESS,
+            (last_user_id, sent, failed, len(blocked_ids), broadcast_id)
+        )
+        cursor.executemany(SQL_MARK_BLOCKED, [(uid,) for uid in blocked_ids])
+
+
+def set_broadcast_status(broadcast_id: int, status: str):
+    with db_connection() as conn:
+        finished = status in ("done", "cancelled")
+        conn.execute(
+            SQL_BROADCAST_STATUS,
+            (status, finished, broadcast_id)
+        )
+
+
+def format_broadcast(b: dict) -> str:
+    done = b['sent'] + b['failed'] + b['blocked']
+    percent = done * 100 // b['total'] if b['total'] else 100
+    return (
+        f"📤 **Рассылка #{b['id']}** — {b['status']}\n\n"
+        f"Прогресс: {done}/{b['total']} ({percent}%)\n"
+        f"✅ Отправлено: {b['sent']}\n"
+        f"🚫 Заблокировали бота: {b['blocked']}\n"
+        f"❌ Ошибок: {b['failed']}"
+    )
+
+
+async def send_broadcast_message(bot, user_id: int, text: str) -> str:
+    """'sent' / 'blocked' / 'failed'; RetryAfter пробрасывается наверх для общей паузы"""
+    try:
+        await bot.send_message(user_id, text, parse_mode="Markdown", rate_limit_args=PRIORITY_BULK)
+        return "sent"
+    except Forbidden:
+        return "blocked"
+    except RetryAfter:
+        raise
+    except Exception as e:
+        logger.warning(f"Broadcast to {user_id} failed: {e}")
+        return "failed"
+
+
+async def run_broadcast(bot, broadcast: dict):
+    """Фоновая рассылка: пачки раз в секунду, скорость растёт до BROADCAST_MAX_RATE и падает вдвое при flood wait.
+    
+    После каждой пачки прогресс пишется в БД, так что после рестарта рассылка продолжается с курсора.
+    """
+    bid = broadcast['id']
+    last_user_id = broadcast['last_user_id']
+    rate = BROADCAST_RATE
+    BROADCAST_STATE[bid] = "running"
+    
+    try:
+        while BROADCAST_STATE.get(bid) == "running":
+            recipients = await db_call(next_broadcast_recipients, last_user_id, rate)
+            if not recipients:
+                BROADCAST_STATE[bid] = "done"
+                await db_write(set_broadcast_status, bid, "done")
+                break
+            
+            started = time.monotonic()
+            counts = {"sent": 0, "failed": 0}
+            blocked_ids = []
+            pending = recipients
+            
+            while pending:
+                results = await asyncio.gather(
+                    *(send_broadcast_message(bot, uid, broadcast['text']) for uid in pending),
+                    return_exceptions=True
                 )
-            except:
-                pass
+                flood = [(uid, r) for uid, r in zip(pending, results) if isinstance(r, RetryAfter)]
+                for uid, result in zip(pending, results):
+                    if result == "blocked":
+                        blocked_ids.append(uid)
+                    elif result == "sent":
+                        counts["sent"] += 1
+                    elif not isinstance(result, RetryAfter):
+                        counts["failed"] += 1
+                
+                pending = [uid for uid, _ in flood]
+                if flood:
+                    wait = max(r.retry_after for _, r in flood)
+                    rate = max(1, rate // 2)
+                    logger.warning(f"Broadcast #{bid}: flood wait {wait}s, rate -> {rate}/s")
+                    await asyncio.sleep(wait)
+            
+            last_user_id = recipients[-1]
+            await db_write(save_broadcast_progress, bid, last_user_id, counts["sent"], counts["failed"], blocked_ids)
+            
+            rate = min(BROADCAST_MAX_RATE, rate + 1)
+            await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
+    except Exception as e:
+        logger.error(f"Broadcast #{bid} crashed: {e}")
+        BROADCAST_STATE.pop(bid, None)
+        try:
+            # На паузу, чтобы её можно было продолжить с курсора через /broadcast_resume
+            await db_write(set_broadcast_status, bid, "paused")
+        except Exception as db_error:
+            logger.error(f"Broadcast #{bid}: failed to pause after crash: {db_error}")
+        try:
+            await bot.send_message(
+                broadcast['admin_chat_id'],
+                f"❌ Рассылка #{bid} прервалась с ошибкой: {e}\n\nПродолжить с того же места: /broadcast_resume {bid}"
+            )
+        except TelegramError:
+            pass
+        return
+    finally:
+        if BROADCAST_STATE.get(bid) == "running":
+            # Отмена задачи (остановка бота): статус в БД остаётся running, при старте рассылка продолжится
+            BROADCAST_STATE.pop(bid, None)
+    
+    status = BROADCAST_STATE.pop(bid, None)
+    if status in ("done", "cancelled"):
+        final = await db_call(get_broadcast, bid)
+        logger.info(f"Broadcast #{bid} {status}: {final['sent']} sent")
+        try:
+            await bot.send_message(broadcast['admin_chat_id'], format_broadcast(final), parse_mode="Markdown")
+        except TelegramError:
+            pass
+
+
+def start_broadcast(bot, broadcast: dict):
+    task = asyncio.create_task(run_broadcast(bot, broadcast))
+    BROADCAST_TASKS.add(task)
+    task.add_done_callback(BROADCAST_TASKS.discard)
+
+
+async def resume_broadcasts(app: Application):
+    for broadcast in await db_call(get_running_broadcasts):
+        logger.info(f"Resuming broadcast #{broadcast['id']} after user {broadcast['last_user_id']}")
+        start_broadcast(app.bot, broadcast)
+
+
+async def stop_broadcasts():
+    tasks = list(BROADCAST_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if tasks:
+        logger.info(f"Broadcasts interrupted for shutdown: {len(tasks)}")
+
+
+# ============================================================
+# === ПЛАНЫ ЗАПРОСОВ ===
+# ============================================================
+
+# Запрос читает всю таблицу намеренно: агрегаты по всей таблице, каталог упражнений
+FULL_SCAN = "FULL SCAN"
+
+# Каждый SQL_* и что обязано быть в его плане: имя индекса, "INTEGER PRIMARY KEY",
+# FULL_SCAN или None (INSERT без поиска — лишь бы без SCAN таблицы).
+# Новый SQL_* без записи здесь роняет tests/test_query_plans.py.
+QUERY_PLANS = (
+    ("SQL_PING", None),
+    ("SQL_COUNT_USERS", FULL_SCAN),
+    ("SQL_COUNT_PREMIUM", "idx_users_premium_day"),
+    ("SQL_COUNT_WORKOUTS", FULL_SCAN),
+    ("SQL_STATS_TOTALS", FULL_SCAN),
+    ("SQL_STATS_ADD", "INTEGER PRIMARY KEY"),
+    ("SQL_LOAD_PREMIUM", "idx_users_premium_day"),
+    ("SQL_EXTEND_PREMIUM", "INTEGER PRIMARY KEY"),
+    ("SQL_EXPIRE_PREMIUM", "idx_users_premium_day"),
+    ("SQL_USER_BY_REFERRAL_CODE", "sqlite_autoindex_users_1"),
+    ("SQL_USER_REFERRED_BY", "INTEGER PRIMARY KEY"),
+    ("SQL_SET_REFERRED_BY", "INTEGER PRIMARY KEY"),
+    ("SQL_RESERVE_QUESTION", "INTEGER PRIMARY KEY"),
+    ("SQL_REFUND_QUESTION", "INTEGER PRIMARY KEY"),
+    ("SQL_REFERRAL_CODE", "INTEGER PRIMARY KEY"),
+    ("SQL_USER_STATS", "INTEGER PRIMARY KEY"),
+    ("SQL_SET_BLOCKED", "INTEGER PRIMARY KEY"),
+    ("SQL_UPDATE_USER_FIELDS", "INTEGER PRIMARY KEY"),
+    ("SQL_SELECT_USER", "INTEGER PRIMARY KEY"),
+    ("SQL_INSERT_USER", None),
+    ("SQL_INSERT_STATS", None),
+    ("SQL_GET_VOICE", "sqlite_autoindex_voice_cache_1"),
+    ("SQL_TOUCH_VOICE", "sqlite_autoindex_voice_cache_1"),
+    ("SQL_SAVE_VOICE", None),
+    # Кэш озвучки ограничен VOICE_CACHE_MAX_BYTES: сумма размеров по небольшой таблице
+    ("SQL_VOICE_CACHE_SIZE", FULL_SCAN),
+    ("SQL_VOICE_FILES_LRU", "idx_voice_cache_used"),
+    ("SQL_SAVE_VOICE_FILE", None),
+    ("SQL_EVICT_VOICE_FILE", "sqlite_autoindex_voice_cache_1"),
+    ("SQL_DELETE_EMPTY_VOICE", "sqlite_autoindex_voice_cache_1"),
+    ("SQL_STALE_VOICE_FILES", "idx_voice_cache_used"),
+    ("SQL_DELETE_STALE_VOICE", "idx_voice_cache_used"),
+    # Только при старте: сверка файлов на диске со строками
+    ("SQL_VOICE_FILE_HASHES", FULL_SCAN),
+    ("SQL_ADD_WEIGHT", None),
+    ("SQL_SET_WEIGHT", "INTEGER PRIMARY KEY"),
+    ("SQL_WEIGHT_HISTORY", "idx_progress_user_date"),
+    ("SQL_ADD_WORKOUT", None),
+    ("SQL_COMPLETE_WORKOUT", "INTEGER PRIMARY KEY"),
+    ("SQL_SET_REMINDER", "INTEGER PRIMARY KEY"),
+    ("SQL_USERS_WITH_REMINDERS", "idx_users_reminders"),
+    ("SQL_ADD_CHAT_MESSAGE", None),
+    ("SQL_TRIM_CHAT_HISTORY", "idx_chat_history_user"),
+    ("SQL_CHAT_HISTORY", "idx_chat_history_user"),
+    ("SQL_CLEAR_CHAT_HISTORY", "idx_chat_history_user"),
+    ("SQL_EXERCISE_CATALOG", FULL_SCAN),
+    ("SQL_EXERCISES_LIST", FULL_SCAN),
+    ("SQL_GET_EXERCISE_MEDIA", "sqlite_autoindex_exercise_media_1"),
+    ("SQL_SAVE_EXERCISE_MEDIA", None),
+    ("SQL_SET_EXERCISE_GIF", "INTEGER PRIMARY KEY"),
+    ("SQL_SET_MEDIA_GIF", "sqlite_autoindex_exercise_media_1"),
+    ("SQL_GET_LLM_CACHE", "idx_llm_cache_key"),
+    ("SQL_ADD_LLM_CACHE", None),
+    ("SQL_TRIM_LLM_CACHE", "INTEGER PRIMARY KEY"),
+    ("SQL_PRUNE_LLM_CACHE", "idx_llm_cache_created"),
+    ("SQL_COUNT_RECIPIENTS", "idx_users_blocked"),
+    ("SQL_CREATE_BROADCAST", None),
+    # ORDER BY id DESC LIMIT 1 — обратный обход rowid, читается одна строка
+    ("SQL_LAST_BROADCAST", FULL_SCAN),
+    ("SQL_GET_BROADCAST", "INTEGER PRIMARY KEY"),
+    ("SQL_RUNNING_BROADCASTS", "idx_broadcasts_running"),
+    ("SQL_BROADCAST_RECIPIENTS", "idx_users_blocked"),
+    ("SQL_BROADCAST_PROGRESS", "INTEGER PRIMARY KEY"),
+    ("SQL_MARK_BLOCKED", "INTEGER PRIMARY KEY"),
+    ("SQL_BROADCAST_STATUS", "INTEGER PRIMARY KEY"),
+)
+
+# Подстановки для шаблонов, собираемых во время выполнения
+QUERY_PLAN_TEMPLATE_ARGS = {
+    "SQL_UPDATE_USER_FIELDS": {"fields": "weight = ?, goal = ?"},
+}
+
+
+def explain_query(conn, sql: str) -> str:
+    """План запроса одной строкой; параметры подставляются нулями"""
+    names = re.findall(r"(?<!:):(\w+)", sql)
+    params = dict.fromkeys(names, 0) if names else (0,) * sql.count("?")
+    return "; ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def check_query_plan(plan: str, expected) -> bool:
+    """SCAN таблицы без индекса допустим только для FULL_SCAN, сортировка во временном B-дереве — никогда"""
+    if "TEMP B-TREE" in plan:
+        return False
+    if expected == FULL_SCAN:
+        return True
+    steps = plan.split("; ")
+    if any(step.startswith("SCAN ") and " USING " not in step and step != "SCAN CONSTANT ROW" for step in steps):
+        return False
+    return expected is None or expected in plan
+
+
+def audit_query_plans() -> list:
+    """EXPLAIN QUERY PLAN для всех QUERY_PLANS: [(имя, план, ok)]"""
+    results = []
+    with db_connection() as conn:
+        for name, expected in QUERY_PLANS:
+            sql = globals()[name].format(**QUERY_PLAN_TEMPLATE_ARGS.get(name, {}))
+            plan = explain_query(conn, sql)
+            results.append((name, plan, check_query_plan(plan, expected)))
+    return results
 
 
 # ============================================================
@@ -1885,18 +4460,30 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Нет доступа.\n\nТвой ID: `{update.effective_user.id}`", parse_mode="Markdown")
         return
     
-    stats = get_backup_stats()
+    stats = await db_call(get_backup_stats)
+    cache = USER_CACHE.stats()
+    llm = GROQ_FLIGHTS.stats()
+    governor = GROQ_GOVERNOR.stats()
+    outbound = OUTBOUND.stats()
+    writer = DB_WRITER.stats()
     await update.message.reply_text(
         f"🔧 **Админ-панель**\n\n"
         f"👥 Пользователей: {stats['users']}\n"
         f"💎 Premium: {stats['premium']}\n"
         f"💪 Тренировок: {stats['workouts']}\n"
         f"💬 Вопросов: {stats['questions']}\n"
-        f"📊 Размер БД: {stats['size_kb']:.1f} KB\n\n"
+        f"📊 Размер БД: {stats['size_kb']:.1f} KB\n"
+        f"🗂 Кэш: {cache['records']} польз., {cache['bytes'] / 1024:.0f}/{cache['max_bytes'] / 1024:.0f} KB, "
+        f"hit {cache['hit_rate']:.0%} ({cache['hits']}/{cache['misses']})\n"
+        f"✍️ Запись в БД: {writer['writes']} операций в {writer['batches']} транзакциях\n"
+        f"🤖 Groq: {llm['upstream']} вызовов, {llm['coalesced']} склеено, "
+        f"очередь {governor['queue']}, в работе {governor['in_flight']}, 429: {governor['throttled']}\n"
+        f"📨 Исходящие: {outbound['sent']} отправлено, очередь {outbound['queue']}, flood wait: {outbound['throttled']}\n\n"
         f"**Команды:**\n"
         f"`/give_premium ID 30` — выдать Premium\n"
         f"`/backup` — создать бэкап\n"
         f"`/logs` — показать ошибки\n"
+        f"`/db_audit` — планы горячих запросов\n"
         f"`/broadcast текст` — рассылка",
         parse_mode="Markdown"
     )
@@ -1914,7 +4501,7 @@ async def give_premium_command(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         target = int(context.args[0])
         days = int(context.args[1]) if len(context.args) > 1 else 30
-        activate_premium(target, days)
+        await db_write(activate_premium, target, days)
         await update.message.reply_text(f"✅ Выдано **{days} дней** Premium для `{target}`", parse_mode="Markdown")
         
         try:
@@ -1939,6 +4526,12 @@ async def backup_now_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await backup_database(context)
 
 
+def read_log_tail(path: str, lines: int = 30, max_chars: int = 3500) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        tail = f.readlines()[-lines:]
+    return ''.join(tail)[-max_chars:]
+
+
 @handle_errors
 async def logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
@@ -1946,52 +4539,132 @@ async def logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     error_log = os.path.join(LOG_DIR, 'errors.log')
     if os.path.exists(error_log):
-        with open(error_log, 'r', encoding='utf-8') as f:
-            lines = f.readlines()[-30:]
-        text = ''.join(lines)[-3500:]
+        text = await asyncio.to_thread(read_log_tail, error_log)
         await update.message.reply_text(f"📝 **Последние ошибки:**\n```\n{text}\n```", parse_mode="Markdown")
     else:
         await update.message.reply_text("📝 Файл ошибок пуст!")
 
 
+@handle_errors
+async def db_audit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    results = await db_call(audit_query_plans)
+    # Все планы не влезут в одно сообщение — показываем только проблемные
+    lines = [f"❌ {name}: {plan}" for name, plan, ok in results if not ok]
+    await update.message.reply_text(
+        f"🔎 **Планы запросов** (схема v{SCHEMA_VERSION}, проверено: {len(results)}, проблем: {len(lines)})"
+        + ("\n```\n" + "\n".join(lines) + "\n```" if lines else ""),
+        parse_mode="Markdown"
+    )
+
+
 @handle_errors
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
     
     if not context.args:
-        await update.message.reply_text("Использование: `/broadcast текст сообщения`", parse_mode="Markdown")
+        await update.message.reply_text(
+            "Использование: `/broadcast текст сообщения`\n\n"
+            "Управление: `/broadcast_status`, `/broadcast_pause`, `/broadcast_resume`, `/broadcast_cancel` [ID]",
+            parse_mode="Markdown"
+        )
+        return
+    
+    if "running" in BROADCAST_STATE.values():
+        await update.message.reply_text("⚠️ Уже идёт рассылка, дождись её или отмени: /broadcast_cancel")
         return
     
-    msg = " ".join(context.args)
+    # Текст берём из сообщения целиком, чтобы сохранить переносы строк
+    msg = update.message.text.split(maxsplit=1)[1]
     
+    broadcast = await db_write(create_broadcast, msg, update.effective_chat.id)
+    start_broadcast(context.bot, broadcast)
+    await update.message.reply_text(
+        f"📤 Рассылка #{broadcast['id']} запущена для {broadcast['total']} пользователей.\n"
+        f"Прогресс: /broadcast_status"
+    )
+
+
+async def get_broadcast_from_args(update: Update, context: ContextTypes.DEFAULT_TYPE) -> dict | None:
     try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM users")
-            users = cursor.fetchall()
-        
-        await update.message.reply_text(f"📤 Рассылка для {len(users)} пользователей...")
-        
-        success = 0
-        failed = 0
-        
-        for (uid,) in users:
-            try:
-                await context.bot.send_message(uid, msg, parse_mode="Markdown")
-                success += 1
-                await asyncio.sleep(0.05)
-            except:
-                failed += 1
-        
-        await update.message.reply_text(
-            f"✅ **Рассылка завершена**\n\n"
-            f"📤 Отправлено: {success}\n"
-            f"❌ Ошибок: {failed}",
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {e}")
+        broadcast_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("❌ ID должен быть числом")
+        return None
+    
+    broadcast = await db_call(get_broadcast, broadcast_id)
+    if not broadcast:
+        await update.message.reply_text("📭 Рассылок нет")
+    return broadcast
+
+
+@handle_errors
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    broadcast = await get_broadcast_from_args(update, context)
+    if broadcast:
+        await update.message.reply_text(format_broadcast(broadcast), parse_mode="Markdown")
+
+
+@handle_errors
+async def broadcast_pause_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    broadcast = await get_broadcast_from_args(update, context)
+    if not broadcast:
+        return
+    if broadcast['status'] != "running":
+        await update.message.reply_text(f"Рассылка #{broadcast['id']} не идёт ({broadcast['status']})")
+        return
+    
+    BROADCAST_STATE[broadcast['id']] = "paused"
+    await db_write(set_broadcast_status, broadcast['id'], "paused")
+    await update.message.reply_text(f"⏸ Рассылка #{broadcast['id']} на паузе. Продолжить: /broadcast_resume")
+
+
+@handle_errors
+async def broadcast_resume_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    broadcast = await get_broadcast_from_args(update, context)
+    if not broadcast:
+        return
+    if broadcast['status'] != "paused":
+        await update.message.reply_text(f"Рассылка #{broadcast['id']} не на паузе ({broadcast['status']})")
+        return
+    
+    await db_write(set_broadcast_status, broadcast['id'], "running")
+    if BROADCAST_STATE.get(broadcast['id']) == "paused":
+        # Задача ещё не дошла до проверки статуса — просто продолжит работу
+        BROADCAST_STATE[broadcast['id']] = "running"
+    else:
+        start_broadcast(context.bot, broadcast)
+    await update.message.reply_text(f"▶️ Рассылка #{broadcast['id']} продолжена")
+
+
+@handle_errors
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    broadcast = await get_broadcast_from_args(update, context)
+    if not broadcast:
+        return
+    if broadcast['status'] not in ("running", "paused"):
+        await update.message.reply_text(f"Рассылка #{broadcast['id']} уже завершена ({broadcast['status']})")
+        return
+    
+    if broadcast['id'] in BROADCAST_STATE:
+        BROADCAST_STATE[broadcast['id']] = "cancelled"
+    await db_write(set_broadcast_status, broadcast['id'], "cancelled")
+    await update.message.reply_text(f"⏹ Рассылка #{broadcast['id']} отменена")
 
 
 # ============================================================
@@ -2016,32 +4689,78 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 # === MAIN ===
 # ============================================================
 
-def main():
-    logger.info("=" * 50)
-    logger.info("Starting Murasaki Sport Bot...")
-    logger.info(f"Database: {DB_NAME}")
-    logger.info(f"Admin IDs: {ADMIN_IDS}")
-    logger.info(f"Required channel: {REQUIRED_CHANNEL}")
-    logger.info(f"Check subscription: {CHECK_SUBSCRIPTION}")
-    logger.info("=" * 50)
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных пользователей обрабатываются параллельно, одного — строго по очереди.
     
-    # Проверка админ ID
-    if ADMIN_IDS == [123456789]:
-        logger.warning("⚠️ ADMIN_IDS не настроен! Замени на свой Telegram ID")
+    Медленная запись или ответ Groq держат только своего пользователя; порядок
+    его сообщений, user_data и UserContext остаются как при последовательной обработке.
+    """
     
-    try:
-        init_db()
-    except Exception as e:
-        logger.critical(f"Database init failed: {e}")
-        sys.exit(1)
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._users = {}  # user_id -> [Lock, сколько апдейтов ждут или выполняются]
     
-    # Создаём папки
-    for d in [VOICE_DIR, LOG_DIR]:
-        if not os.path.exists(d):
-            os.makedirs(d)
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        
+        entry = self._users.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[user.id]
+    
+    async def initialize(self):
+        pass
     
-    # Создаём приложение
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    async def shutdown(self):
+        pass
+
+
+# Фоновые задачи старта (прогрев гифок) — как и рассылки, вне Application.create_task,
+# чтобы stop() их не дожидался; отменяются в on_stop
+STARTUP_TASKS = set()
+
+
+async def on_startup(app: Application):
+    await HTTP.warm_up()
+    task = asyncio.create_task(prewarm_exercise_gifs(app.bot))
+    STARTUP_TASKS.add(task)
+    task.add_done_callback(STARTUP_TASKS.discard)
+    await resume_broadcasts(app)
+
+
+async def on_stop(app: Application):
+    tasks = list(STARTUP_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await stop_broadcasts()
+
+
+async def on_shutdown(app: Application):
+    await HTTP.close()
+    flushed = await db_write(STATS_BUFFER.flush)
+    logger.info(f"Stats flushed on shutdown: {flushed} users")
+
+
+def build_application(builder=None) -> Application:
+    """Приложение со всеми хендлерами и фоновыми задачами; builder — для подмены транспорта в тестах"""
+    app = (
+        (builder or Application.builder().token(TELEGRAM_BOT_TOKEN))
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .rate_limiter(OUTBOUND)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Команды пользователя
     app.add_handler(CommandHandler("start", start))
@@ -2058,7 +4777,12 @@ def main():
     app.add_handler(CommandHandler("give_premium", give_premium_command))
     app.add_handler(CommandHandler("backup", backup_now_command))
     app.add_handler(CommandHandler("logs", logs_command))
+    app.add_handler(CommandHandler("db_audit", db_audit_command))
     app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+    app.add_handler(CommandHandler("broadcast_pause", broadcast_pause_command))
+    app.add_handler(CommandHandler("broadcast_resume", broadcast_resume_command))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
     
     # Callbacks
     app.add_handler(CallbackQueryHandler(button_callback))
@@ -2067,6 +4791,10 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     
+    # Подписчики канала (кэш подписки)
+    app.add_handler(ChatMemberHandler(track_channel_member, ChatMemberHandler.CHAT_MEMBER))
+    app.add_handler(ChatMemberHandler(track_bot_blocked, ChatMemberHandler.MY_CHAT_MEMBER))
+    
     # Платежи
     app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
@@ -2077,24 +4805,76 @@ def main():
     # Фоновые задачи
     job_queue = app.job_queue
     if job_queue:
-        # Проверка напоминаний каждую минуту
-        job_queue.run_repeating(check_reminders, interval=60, first=10)
+        # Проверка напоминаний каждую минуту, в начале минуты
+        job_queue.run_repeating(check_reminders, interval=60, first=61 - datetime.now().second)
         # Бэкап в 3:00
         job_queue.run_daily(backup_database, time=dtime(hour=3, minute=0))
         # Health check каждый час
         job_queue.run_repeating(health_check, interval=3600, first=300)
-        # Очистка голосовых файлов каждые 30 минут
-        job_queue.run_repeating(cleanup_voice_job, interval=1800, first=60)
+        # Очистка устаревших ответов LLM раз в час
+        job_queue.run_repeating(prune_llm_cache_job, interval=3600, first=600)
+        # Очистка давно не использованных записей кэша озвучки раз в сутки
+        job_queue.run_repeating(prune_voice_cache_job, interval=24 * 3600, first=900)
+        # Снятие истёкшего premium раз в час (при старте — в main)
+        job_queue.run_repeating(expire_premium_job, interval=3600, first=3600)
+        # Сброс накопленных счётчиков stats
+        job_queue.run_repeating(flush_stats_job, interval=STATS_FLUSH_INTERVAL, first=STATS_FLUSH_INTERVAL)
+        # Очистка истёкших записей кэша подписки
+        job_queue.run_repeating(prune_subscriptions_job, interval=SUBSCRIPTION_TTL, first=SUBSCRIPTION_TTL)
+    
+    return app
+
+
+def main():
+    logger.info("=" * 50)
+    logger.info("Starting Murasaki Sport Bot...")
+    logger.info(f"Database: {DB_NAME}")
+    logger.info(f"Admin IDs: {ADMIN_IDS}")
+    logger.info(f"Required channel: {REQUIRED_CHANNEL}")
+    logger.info(f"Check subscription: {CHECK_SUBSCRIPTION}")
+    logger.info("=" * 50)
+    
+    # Проверка админ ID
+    if ADMIN_IDS == [123456789]:
+        logger.warning("⚠️ ADMIN_IDS не настроен! Замени на свой Telegram ID")
+    
+    try:
+        init_db()
+        for name, plan, ok in audit_query_plans():
+            if not ok:
+                logger.warning(f"Query plan regression: {name}: {plan}")
+        EXERCISE_INDEX.reload()
+        DB_WRITER.submit(expire_premium).result()
+        PREMIUM.load()
+        REMINDERS.load()
+    except Exception as e:
+        logger.critical(f"Database init failed: {e}")
+        sys.exit(1)
+    
+    # Создаём папки
+    for d in [VOICE_CACHE_DIR, LOG_DIR]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    sweep_voice_cache_dir()
+    
+    # Создаём приложение
+    app = build_application()
     
     logger.info("=" * 50)
     logger.info("✅ Bot started successfully!")
     logger.info(f"🎙️ Voice: edge-tts (RU/EN/KO)")
     logger.info(f"📁 Logs: {LOG_DIR}")
-    logger.info(f"🔊 Voice temp: {VOICE_DIR}")
+    logger.info(f"🗂️ Voice cache: {VOICE_CACHE_DIR}")
     logger.info("=" * 50)
     
     # Запуск
-    app.run_polling(drop_pending_updates=True)
+    try:
+        # chat_member не приходит без явного allowed_updates
+        app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    finally:
+        DB_WRITER.close()
+        DB_EXECUTOR.shutdown(wait=True)
+        DB_POOL.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,21 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# main читает окружение при импорте: токены-заглушки и БД во временной папке
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ["RAILWAY_VOLUME_MOUNT_PATH"] = tempfile.mkdtemp(prefix="murasaki-test-")
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def db():
+    main.init_db()
+    return main.DB_NAME
@@ -0,0 +1,138 @@
+"""Бенчмарк: медленная запись одного пользователя не задерживает апдейты остальных.
+
+Апдейты идут через тот же путь, что и при polling: update_processor.process_update
+поверх Application.process_update; Bot API подменён локальным BaseRequest.
+"""
+import asyncio
+import json
+import time
+
+import pytest
+from telegram import Update
+from telegram.ext import Application, SimpleUpdateProcessor
+from telegram.request import BaseRequest
+
+import main
+
+SLOW_WRITE = 1.0
+OTHER_USERS = 10
+
+
+class FakeBotApi(BaseRequest):
+    def __init__(self):
+        self.sent = []
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "test_bot"}
+        else:
+            self.sent.append((endpoint, params.get("chat_id")))
+            result = {
+                "message_id": len(self.sent), "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"}, "text": params.get("text", ""),
+            }
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def command_update(update_id: int, user_id: int, command: str, bot) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+        },
+    }, bot)
+
+
+@pytest.fixture
+def app(db, monkeypatch):
+    api = FakeBotApi()
+    app = main.build_application(Application.builder().token("1:test").request(api).updater(None))
+    
+    # /clear держит транзакцию писателя SLOW_WRITE секунд
+    clear_history = main.clear_history
+    
+    def slow_clear_history(user_id):
+        time.sleep(SLOW_WRITE)
+        clear_history(user_id)
+    
+    monkeypatch.setattr(main, "clear_history", slow_clear_history)
+    app.bot_api = api
+    return app
+
+
+async def measure(app, processor) -> tuple:
+    """(время медленного /clear, задержки /stats остальных пользователей)"""
+    for user_id in range(2, OTHER_USERS + 2):
+        await main.get_user_context(user_id)
+    
+    async def dispatch(update):
+        started = time.perf_counter()
+        await processor.process_update(update, app.process_update(update))
+        return time.perf_counter() - started
+    
+    slow = asyncio.create_task(dispatch(command_update(1, 1, "/clear", app.bot)))
+    await asyncio.sleep(0.05)
+    others = [
+        asyncio.create_task(dispatch(command_update(100 + user_id, user_id, "/stats", app.bot)))
+        for user_id in range(2, OTHER_USERS + 2)
+    ]
+    latencies = await asyncio.gather(*others)
+    return await slow, latencies
+
+
+def test_other_users_latency_stays_flat_during_slow_write(app):
+    async def run():
+        async with app:
+            concurrent = await measure(app, app.update_processor)
+            sequential = await measure(app, SimpleUpdateProcessor(1))
+        return concurrent, sequential
+    
+    (slow, latencies), (_, sequential) = asyncio.run(run())
+    print(
+        f"\nslow write {slow:.3f}s; others p50 {sorted(latencies)[len(latencies) // 2] * 1000:.1f}ms, "
+        f"max {max(latencies) * 1000:.1f}ms; one-at-a-time max {max(sequential) * 1000:.1f}ms"
+    )
+    
+    assert isinstance(app.update_processor, main.PerUserUpdateProcessor)
+    assert app.update_processor.max_concurrent_updates == main.UPDATE_CONCURRENCY > 1
+    assert slow >= SLOW_WRITE
+    answered = {chat_id for endpoint, chat_id in app.bot_api.sent if endpoint == "sendMessage"}
+    assert answered >= set(range(1, OTHER_USERS + 2))
+    assert max(latencies) < SLOW_WRITE / 4
+    # Без параллельной обработки те же апдейты ждут медленную запись
+    assert max(sequential) >= SLOW_WRITE / 2
+
+
+def test_updates_of_one_user_stay_ordered():
+    processor = main.PerUserUpdateProcessor(8)
+    order = []
+    
+    async def handle(tag, delay):
+        await asyncio.sleep(delay)
+        order.append(tag)
+    
+    async def run():
+        bot = None
+        updates = [command_update(i, 7, "/help", bot) for i in range(3)]
+        other = command_update(10, 8, "/help", bot)
+        await asyncio.gather(
+            processor.process_update(updates[0], handle("a1", 0.05)),
+            processor.process_update(updates[1], handle("a2", 0.01)),
+            processor.process_update(other, handle("b", 0)),
+            processor.process_update(updates[2], handle("a3", 0)),
+        )
+    
+    asyncio.run(run())
+    assert order == ["b", "a1", "a2", "a3"]
+    assert processor._users == {}
@@ -0,0 +1,102 @@
+import random
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture(scope="module")
+def index(db):
+    index = main.ExerciseIndex()
+    index.reload()
+    return index
+
+
+def name_of(index, query):
+    entry = index.search(query)
+    return entry and entry['name']
+
+
+@pytest.mark.parametrize("query,expected", [
+    ("Приседания", "Приседания"),
+    ("приседаний", "Приседания"),
+    ("отжиманий", "Отжимания"),
+    ("планку", "Планка"),
+    ("становую тягу", "Становая тяга"),
+    ("жим лежа", "Жим лёжа"),
+    ("как правильно делать приседания", "Приседания"),
+])
+def test_inflected_forms(index, query, expected):
+    assert name_of(index, query) == expected
+
+
+@pytest.mark.parametrize("query,expected", [
+    ("присидания", "Приседания"),
+    ("отжимния", "Отжимания"),
+    ("падтягивания", "Подтягивания"),
+])
+def test_typos(index, query, expected):
+    assert name_of(index, query) == expected
+
+
+@pytest.mark.parametrize("query,expected", [
+    ("squat", "Приседания"),
+    ("push-up", "Отжимания"),
+    ("deadlift", "Становая тяга"),
+    ("bench press", "Жим лёжа"),
+    ("burpee", "Бёрпи"),
+    ("lunges", "Выпады"),
+])
+def test_english_aliases(index, query, expected):
+    assert name_of(index, query) == expected
+
+
+@pytest.mark.parametrize("query", ["жим ногами", "тяга гантели", "тяга гантелей", "турник", "", "как правильно"])
+def test_unrelated_or_partial_queries_find_nothing(index, query):
+    assert index.search(query) is None
+
+
+SYLLABLES = ["ба", "ве", "ги", "до", "жу", "зы", "ка", "ле", "ми", "но", "пу", "ры", "са", "те", "фи", "хо", "ча", "шу"]
+
+
+def synthetic_catalog(size: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    words = sorted({"".join(rng.choices(SYLLABLES, k=rng.randint(3, 5))) for _ in range(size)})
+    rows = []
+    for i in range(size):
+        name = " ".join(rng.sample(words, rng.randint(1, 3)))
+        aliases = ",".join(" ".join(rng.sample(words, rng.randint(1, 2))) for _ in range(2))
+        rows.append((i + 1, name, aliases, "", "", None, None, None, None))
+    return rows
+
+
+def mean_search_time(index, queries) -> float:
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query)
+    return (time.perf_counter() - started) / len(queries)
+
+
+CATALOG_SIZE = 5000
+
+
+def test_search_stays_under_a_millisecond_as_catalog_grows():
+    rng = random.Random(1)
+    timings = {}
+    for n in (100, CATALOG_SIZE):
+        rows = synthetic_catalog(n)
+        index = main.ExerciseIndex()
+        index.build(rows)
+        names = [row[1] for row in rows]
+        queries = []
+        for _ in range(500):
+            name = rng.choice(names)
+            queries.append(name)                                      # точное название
+            queries.append(name[:-1] + "ы")                           # другая форма
+            queries.append(name[:3] + name[4:])                       # опечатка
+            queries.append("".join(rng.choices(SYLLABLES, k=4)))      # нет в каталоге
+        timings[n] = mean_search_time(index, queries)
+    
+    print("\n" + ", ".join(f"{n} entries: {t * 1e6:.0f}µs/search" for n, t in timings.items()))
+    assert timings[CATALOG_SIZE] < 0.001
@@ -0,0 +1,29 @@
+import asyncio
+
+import main
+
+CALLERS = 10
+
+
+def test_coalesced_callers_store_one_cache_row(db, monkeypatch):
+    calls = []
+    
+    async def fake_retry(func, max_retries=3, delay=2):
+        calls.append(func)
+        await asyncio.sleep(0.05)
+        return "Овсянка с ягодами"
+    
+    monkeypatch.setattr(main, "retry_async", fake_retry)
+    prompt = "Рецепт завтрака для теста кэша"
+    
+    async def run():
+        users = [await main.get_user_context(500 + i) for i in range(CALLERS)]
+        replies = await asyncio.gather(*(main.groq_chat(uctx, prompt, use_context=False) for uctx in users))
+        return replies, users[0]
+    
+    replies, uctx = asyncio.run(run())
+    variants = main.get_cached_responses(main.llm_cache_key(prompt, uctx.profile))
+    
+    assert replies == ["Овсянка с ягодами"] * CALLERS
+    assert len(calls) == 1
+    assert variants == ["Овсянка с ягодами"]
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import main
+
+
+class FakeStream:
+    def __init__(self, events):
+        self.content = self._lines(events)
+    
+    @staticmethod
+    async def _lines(events):
+        for event in events:
+            yield f"data: {json.dumps(event) if isinstance(event, dict) else event}\n".encode()
+
+
+def delta(text):
+    return {"choices": [{"delta": {"content": text}}]}
+
+
+def test_stream_reports_usage_from_final_chunk():
+    usage = {}
+    partials = []
+    
+    async def on_partial(text):
+        partials.append(text)
+    
+    resp = FakeStream([
+        delta("Привет"), delta(", атлет"),
+        {"choices": [], "usage": {"prompt_tokens": 120, "completion_tokens": 30, "total_tokens": 150}},
+        "[DONE]",
+    ])
+    text = asyncio.run(main.read_groq_stream(resp, on_partial, usage))
+    
+    assert text == "Привет, атлет"
+    assert partials == ["Привет", "Привет, атлет"]
+    assert usage == {'total_tokens': 150}
+
+
+def test_stream_reads_groq_usage_extension():
+    usage = {}
+    resp = FakeStream([delta("Ок"), {"choices": [], "x_groq": {"usage": {"total_tokens": 42}}}, "[DONE]"])
+    
+    async def on_partial(text):
+        pass
+    
+    asyncio.run(main.read_groq_stream(resp, on_partial, usage))
+    assert usage == {'total_tokens': 42}
+
+
+def test_slot_refunds_unused_estimate():
+    governor = main.LLMGovernor(rpm=30, tpm=12000, max_concurrency=4)
+    
+    async def run():
+        async with governor.slot(main.PRIORITY_INTERACTIVE, 1500) as usage:
+            usage['total_tokens'] = 200
+    
+    asyncio.run(run())
+    # Списано 200 фактических токенов, а не 1500 по оценке
+    assert governor._tokens >= 12000 - 200 - 1
+
+
+def test_streamed_call_asks_for_usage(monkeypatch):
+    bodies = []
+    
+    class Response:
+        status = 200
+        headers = {}
+        content = FakeStream([delta("Да"), {"choices": [], "usage": {"total_tokens": 10}}, "[DONE]"]).content
+        
+        async def __aenter__(self):
+            return self
+        
+        async def __aexit__(self, *exc):
+            return False
+    
+    class Session:
+        def post(self, url, json=None, headers=None, timeout=None):
+            bodies.append(json)
+            return Response()
+    
+    monkeypatch.setattr(main.HttpClient, "session", property(lambda self: Session()))
+    monkeypatch.setattr(main, "GROQ_GOVERNOR", main.LLMGovernor(rpm=30, tpm=12000, max_concurrency=4))
+    
+    async def on_partial(text):
+        pass
+    
+    payload = {"model": "m", "messages": [{"role": "user", "content": "usage test"}], "max_tokens": 1000}
+    reply = asyncio.run(main.groq_complete(payload, on_partial=on_partial))
+    
+    assert reply == "Да"
+    assert bodies[0]["stream_options"] == {"include_usage": True}
+    assert main.GROQ_GOVERNOR._tokens >= 12000 - 10 - 1
@@ -0,0 +1,55 @@
+import ast
+import re
+
+import pytest
+
+import main
+
+
+@pytest.fixture(scope="module")
+def plans(db):
+    return {name: (plan, ok) for name, plan, ok in main.audit_query_plans()}
+
+
+def test_every_sql_constant_is_audited():
+    constants = {name for name in vars(main) if name.startswith("SQL_")}
+    audited = [name for name, _ in main.QUERY_PLANS]
+    assert len(audited) == len(set(audited))
+    assert constants == set(audited)
+
+
+def test_no_inline_sql_outside_constants():
+    """Рабочие запросы идут только через SQL_*; литералы остаются в схеме и миграциях"""
+    with open(main.__file__, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    schema = {"init_db", "_insert_default_exercises"}
+    inline = []
+    for func in ast.walk(tree):
+        if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        if func.name in schema or func.name.startswith("_migration_"):
+            continue
+        for node in ast.walk(func):
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr in ("execute", "executemany") and node.args):
+                continue
+            arg = node.args[0]
+            text = arg.value if isinstance(arg, ast.Constant) else ast.unparse(arg)
+            if isinstance(text, str) and re.match(r"\s*f?['\"]*\s*(SELECT|INSERT|UPDATE|DELETE)\b", text):
+                inline.append(f"{func.name}:{node.lineno}")
+    assert inline == []
+
+
+@pytest.mark.parametrize("name,expected", main.QUERY_PLANS)
+def test_query_plan(plans, name, expected):
+    plan, ok = plans[name]
+    assert ok, f"{name}: expected {expected!r}, got plan {plan!r}"
+
+
+def test_full_scan_is_rejected_without_marker():
+    assert not main.check_query_plan("SCAN users", None)
+    assert not main.check_query_plan("SCAN users", "idx_users_blocked")
+    assert main.check_query_plan("SCAN users", main.FULL_SCAN)
+    assert not main.check_query_plan("SEARCH users USING INDEX idx_users_premium_day (premium_day>?)",
+                                     "idx_users_reminders")
+    assert not main.check_query_plan("SEARCH progress USING INDEX x (user_id=?); USE TEMP B-TREE FOR ORDER BY", "x")
@@ -0,0 +1,105 @@
+import asyncio
+import itertools
+from datetime import date, timedelta
+
+import pytest
+
+import main
+
+DAILY = main.FREE_QUESTIONS_PER_DAY
+USER_IDS = itertools.count(8000)
+
+
+def write(func, *args):
+    return main.DB_WRITER.submit(func, *args).result()
+
+
+def set_quota(user_id: int, free_questions: int, last_reset: str):
+    def update():
+        with main.db_connection() as conn:
+            conn.execute(
+                "UPDATE users SET free_questions = ?, last_reset = ? WHERE user_id = ?",
+                (free_questions, last_reset, user_id)
+            )
+    write(update)
+
+
+def quota(user_id: int) -> tuple:
+    with main.db_connection() as conn:
+        return tuple(conn.execute(
+            "SELECT free_questions, last_reset FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone())
+
+
+@pytest.fixture
+def user(db):
+    user_id = next(USER_IDS)
+    write(main.create_user, user_id)
+    return user_id
+
+
+def today() -> str:
+    return date.today().isoformat()
+
+
+def test_daily_allowance_is_spent_then_exhausted(user):
+    remaining = [write(main.reserve_question, user) for _ in range(DAILY)]
+    
+    assert remaining == [(DAILY - i, today()) for i in range(1, DAILY + 1)]
+    assert write(main.reserve_question, user) is None
+    assert quota(user) == (0, today())
+
+
+def test_allowance_is_granted_once_per_day(user):
+    set_quota(user, 0, (date.today() - timedelta(days=1)).isoformat())
+    
+    assert write(main.reserve_question, user) == (DAILY - 1, today())
+    # Повторный вызов в тот же день продолжает списывать, а не сбрасывает лимит заново
+    assert write(main.reserve_question, user) == (DAILY - 2, today())
+
+
+def test_refund_restores_exactly_one_question(user):
+    write(main.reserve_question, user)
+    write(main.reserve_question, user)
+    
+    assert write(main.refund_question, user) == DAILY - 1
+    assert quota(user) == (DAILY - 1, today())
+
+
+def test_refund_never_exceeds_daily_allowance(user):
+    assert write(main.refund_question, user) is None
+    assert quota(user) == (DAILY, today())
+
+
+def test_refund_after_day_rolled_over_does_nothing(user):
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    set_quota(user, 0, yesterday)
+    
+    assert write(main.refund_question, user) is None
+    assert quota(user) == (0, yesterday)
+
+
+def test_concurrent_reserves_never_overspend(user):
+    async def run():
+        return await asyncio.gather(*(main.db_write(main.reserve_question, user) for _ in range(DAILY * 3)))
+    
+    results = asyncio.run(run())
+    
+    assert sum(result is not None for result in results) == DAILY
+    assert quota(user) == (0, today())
+
+
+def test_user_context_refund_only_after_reserve(user):
+    async def run():
+        uctx = await main.get_user_context(user)
+        await uctx.refund_question()
+        assert quota(user) == (DAILY, today())
+        
+        assert await uctx.reserve_question() == (True, DAILY - 1)
+        await uctx.refund_question()
+        await uctx.refund_question()
+        return uctx
+    
+    uctx = asyncio.run(run())
+    assert quota(user) == (DAILY, today())
+    assert uctx.questions_left == DAILY
@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+import main
+
+
+def stats_row(user_id: int) -> dict:
+    def query():
+        with main.db_connection() as conn:
+            row = conn.execute("SELECT total_questions FROM stats WHERE user_id = ?", (user_id,)).fetchone()
+        return {'user_id': user_id, 'total_questions': row[0]}
+    return main.STATS_BUFFER.read(query)
+
+
+@pytest.fixture
+def user(db):
+    user_id = 7100
+    main.DB_WRITER.submit(main.create_user, user_id).result()
+    main.DB_WRITER.submit(main.STATS_BUFFER.flush).result()
+    return user_id
+
+
+def test_flush_goes_through_writer_and_read_stays_exact(user):
+    before = stats_row(user)['total_questions']
+    main.STATS_BUFFER.add(user, {'total_questions': 3})
+    assert stats_row(user)['total_questions'] == before + 3
+    
+    assert main.DB_WRITER.submit(main.STATS_BUFFER.flush).result() >= 1
+    assert main.STATS_BUFFER.stats()['pending_users'] == 0
+    assert stats_row(user)['total_questions'] == before + 3
+
+
+def test_read_waits_until_flush_commits(user):
+    """Между COMMIT и вычитанием дельт read() не должен посчитать их дважды"""
+    main.STATS_BUFFER.add(user, {'total_questions': 2})
+    expected = stats_row(user)['total_questions']
+    committed = threading.Event()
+    release = threading.Event()
+    seen = []
+    
+    def flush_then_hold():
+        flushed = main.STATS_BUFFER.flush()
+        main.after_commit(lambda: (committed.set(), release.wait(5)))
+        return flushed
+    
+    # Колбэки после COMMIT идут по порядку: вычитание дельт ждёт, пока держится наш колбэк
+    future = main.DB_WRITER.submit(flush_then_hold)
+    assert committed.wait(5)
+    reader = threading.Thread(target=lambda: seen.append(stats_row(user)['total_questions']))
+    reader.start()
+    reader.join(0.2)
+    release.set()
+    future.result()
+    reader.join(5)
+    
+    assert seen == [expected]
+
+
+def test_rolled_back_flush_keeps_deltas(user):
+    main.STATS_BUFFER.add(user, {'total_questions': 5})
+    expected = stats_row(user)['total_questions']
+    
+    def flush_then_fail():
+        main.STATS_BUFFER.flush()
+        raise RuntimeError("write failed after flush")
+    
+    with pytest.raises(RuntimeError):
+        main.DB_WRITER.submit(flush_then_fail).result()
+    
+    assert stats_row(user)['total_questions'] == expected
+    assert main.DB_WRITER.submit(main.STATS_BUFFER.flush).result() >= 1
+    assert stats_row(user)['total_questions'] == expected
+    assert main.STATS_BUFFER.stats()['pending_users'] == 0
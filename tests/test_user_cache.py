@@ -0,0 +1,72 @@
+import main
+
+
+def record(user_id: int, **fields) -> main.UserRecord:
+    row = dict.fromkeys(main.USER_COLUMNS)
+    row.update(user_id=user_id, is_premium=0)
+    row.update(fields)
+    return main.UserRecord(row)
+
+
+def test_put_after_write_to_uncached_user_is_dropped():
+    cache = main.UserCache(1 << 20)
+    since = cache.begin_read()
+    stale = record(1)
+    # Писатель закоммитил premium, пока строка читалась; в кэше пользователя ещё нет
+    cache.update(1, is_premium=1)
+    
+    assert not cache.put(stale, since)
+    assert cache.get(1) is None
+    
+    assert cache.put(record(1, is_premium=1), cache.begin_read())
+    assert cache.get(1).is_premium == 1
+
+
+def test_late_put_does_not_replace_updated_record():
+    cache = main.UserCache(1 << 20)
+    slow_read = cache.begin_read()
+    cache.put(record(2), cache.begin_read())
+    cache.update(2, weight=80.0)
+    
+    assert not cache.put(record(2), slow_read)
+    assert cache.get(2).weight == 80.0
+
+
+def test_writes_to_other_users_do_not_block_put():
+    cache = main.UserCache(1 << 20)
+    since = cache.begin_read()
+    cache.update(4, weight=70.0)
+    cache.invalidate(5)
+    
+    assert cache.put(record(3), since)
+
+
+def test_reads_older_than_forgotten_marks_are_not_cached():
+    cache = main.UserCache(1 << 20, write_marks=2)
+    since = cache.begin_read()
+    for user_id in (10, 11, 12):
+        cache.update(user_id, weight=1.0)
+    
+    # Отметка пользователя 10 вытеснена — проверить старое чтение нельзя
+    assert not cache.put(record(10), since)
+    assert cache.put(record(10), cache.begin_read())
+
+
+def test_load_user_context_skips_cache_when_written_during_read(db, monkeypatch):
+    user_id = 9001
+    main.DB_WRITER.submit(main.create_user, user_id).result()
+    main.USER_CACHE.invalidate(user_id)
+    
+    # after_commit писателя срабатывает, пока load_user_context читает строку
+    original_begin = main.USER_CACHE.begin_read
+    
+    def begin_read_then_write():
+        since = original_begin()
+        main.USER_CACHE.update(user_id, is_premium=1)
+        return since
+    
+    monkeypatch.setattr(main.USER_CACHE, "begin_read", begin_read_then_write)
+    uctx = main.load_user_context(user_id)
+    
+    assert uctx.user_id == user_id
+    assert main.USER_CACHE.get(user_id) is None
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import main
+
+
+def voice_row(key: str):
+    with main.db_connection() as conn:
+        return conn.execute("SELECT file_id, size, last_used FROM voice_cache WHERE hash = ?", (key,)).fetchone()
+
+
+def write(func, *args):
+    return main.DB_WRITER.submit(func, *args).result()
+
+
+@pytest.fixture
+def voice_dir(db):
+    os.makedirs(main.VOICE_CACHE_DIR, exist_ok=True)
+    return main.VOICE_CACHE_DIR
+
+
+def test_synthesized_file_is_tracked_before_send(voice_dir, monkeypatch):
+    async def fake_tts(text, voice):
+        return b"ogg" * 100
+    
+    monkeypatch.setattr(main, "generate_voice_response", fake_tts)
+    key = main.voice_cache_key("Разминка перед тренировкой.", "ru-RU-DmitryNeural")
+    
+    audio = asyncio.run(main.synthesize_voice_chunk("Разминка перед тренировкой.", "ru-RU-DmitryNeural", key))
+    
+    # reply_voice ещё не вызывался, а файл уже учтён в лимите размера
+    assert os.path.exists(main.voice_cache_path(key))
+    assert tuple(voice_row(key)[:2]) == (None, len(audio))
+    
+    write(main.save_voice_cache, key, "file-id-1", len(audio))
+    write(main.save_voice_file, key, len(audio))
+    assert voice_row(key)[0] == "file-id-1"
+
+
+def test_prune_removes_stale_rows_with_file_ids_and_files(voice_dir):
+    old = int(time.time()) - main.VOICE_CACHE_TTL - 10
+    with_file, file_id_only, fresh = "a" * 64, "b" * 64, "c" * 64
+    main.write_voice_file(main.voice_cache_path(with_file), b"x" * 10)
+    
+    def seed():
+        with main.db_connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO voice_cache (hash, file_id, size, last_used) VALUES (?, ?, ?, ?)",
+                [(with_file, "f1", 10, old), (file_id_only, "f2", 0, old), (fresh, "f3", 0, int(time.time()))]
+            )
+    
+    write(seed)
+    write(main.prune_voice_cache)
+    
+    assert voice_row(with_file) is None
+    assert voice_row(file_id_only) is None
+    assert voice_row(fresh) is not None
+    assert not os.path.exists(main.voice_cache_path(with_file))
+
+
+def test_sweep_removes_untracked_files(voice_dir):
+    tracked, untracked = "d" * 64, "e" * 64
+    write(main.save_voice_file, tracked, 5)
+    for key in (tracked, untracked):
+        main.write_voice_file(main.voice_cache_path(key), b"12345")
+    partial = main.voice_cache_path("f" * 64) + ".part"
+    open(partial, "wb").close()
+    
+    main.sweep_voice_cache_dir()
+    
+    assert os.path.exists(main.voice_cache_path(tracked))
+    assert not os.path.exists(main.voice_cache_path(untracked))
+    assert not os.path.exists(partial)
@@ -0,0 +1,37 @@
+import main
+
+
+def words(chunks) -> list:
+    return " ".join(chunks).split()
+
+
+def test_long_first_sentence_is_cut_to_first_chunk_limit():
+    text = " ".join(f"слово{i}" for i in range(150)) + ". Короткое второе предложение."
+    chunks = main.split_voice_text(text)
+    
+    assert len(chunks[0]) <= main.VOICE_FIRST_CHUNK_CHARS
+    assert text.startswith(chunks[0] + " ")
+    assert all(len(chunk) <= main.VOICE_CHUNK_CHARS for chunk in chunks)
+    assert words(chunks) == text.split()
+
+
+def test_short_sentences_fill_first_chunk_at_sentence_boundary():
+    sentences = [f"Предложение номер {i} про технику приседаний." for i in range(40)]
+    chunks = main.split_voice_text(" ".join(sentences))
+    
+    assert len(chunks[0]) <= main.VOICE_FIRST_CHUNK_CHARS
+    assert chunks[0].endswith(".")
+    assert all(len(chunk) <= main.VOICE_CHUNK_CHARS for chunk in chunks)
+    assert words(chunks) == " ".join(sentences).split()
+
+
+def test_word_longer_than_limit_is_cut_hard():
+    text = "а" * (main.VOICE_FIRST_CHUNK_CHARS + 50)
+    chunks = main.split_voice_text(text)
+    
+    assert chunks[0] == "а" * main.VOICE_FIRST_CHUNK_CHARS
+    assert "".join(chunks) == text
+
+
+def test_short_text_is_one_chunk():
+    assert main.split_voice_text("Привет! Готов к тренировке?") == ["Привет! Готов к тренировке?"]